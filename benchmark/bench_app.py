@@ -0,0 +1,185 @@
+# coding=utf-8
+# Python 3
+
+import argparse
+import io
+import itertools
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+sys.path.insert(0, SRC_DIR)
+
+from mock_api import MockApi
+from synthetic import write_input_table, LENGTH_DISTRIBUTIONS
+
+INPUT_TABLE = 'input.csv'
+BENCH_PROJECT_ID = 'benchmark'
+
+
+def prepare_data_dir(data_dir, *, count, text_length, distribution):
+    tables_dir = os.path.join(data_dir, 'in', 'tables')
+    os.makedirs(tables_dir, exist_ok=True)
+    os.makedirs(os.path.join(data_dir, 'out', 'tables'), exist_ok=True)
+    chars = write_input_table(os.path.join(tables_dir, INPUT_TABLE), count, text_length=text_length,
+                              distribution=distribution)
+    with open(os.path.join(tables_dir, INPUT_TABLE + '.manifest'), 'w', encoding='utf-8') as manifest_file:
+        json.dump({'id': 'in.c-benchmark.input', 'columns': ['id', 'title', 'text']}, manifest_file)
+    return chars
+
+
+def write_config(data_dir, *, url, analysis_types, advanced):
+    config = {
+        'storage': {
+            'input': {'tables': [{'source': 'in.c-benchmark.input', 'destination': INPUT_TABLE}]}
+        },
+        'parameters': {
+            'user_key': 'benchmark',
+            'columns': {'id': ['id'], 'title': ['title'], 'text': ['text']},
+            'analysis_types': analysis_types,
+            'advanced': dict(advanced, api_url=url)
+        }
+    }
+    with open(os.path.join(data_dir, 'config.json'), 'w', encoding='utf-8') as config_file:
+        json.dump(config, config_file, indent=4)
+
+
+def clean_outputs(data_dir):
+    out_dir = os.path.join(data_dir, 'out', 'tables')
+    shutil.rmtree(out_dir)
+    os.makedirs(out_dir)
+    for filename in ('dead-letter.jsonl', 'checkpoint.json'):
+        if os.path.exists(os.path.join(data_dir, filename)):
+            os.unlink(os.path.join(data_dir, filename))
+
+
+def read_usage(data_dir):
+    with open(os.path.join(data_dir, 'out', 'usage.json'), 'r', encoding='utf-8') as usage_file:
+        return {item['metric']: item['value'] for item in json.load(usage_file)}
+
+
+def run_app(data_dir, *, verbose=False):
+    env = dict(os.environ, KBC_PROJECTID=BENCH_PROJECT_ID)
+    env.pop('KBC_STACKID', None)
+    output = None if verbose else subprocess.DEVNULL
+    start = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, os.path.join(SRC_DIR, 'main.py'), '--data', data_dir],
+                            env=env, stdout=output, stderr=output)
+    # the resource usage of this one child, ru_maxrss is in kilobytes on Linux
+    _, status, rusage = os.wait4(proc.pid, 0)
+    proc.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -1
+    elapsed = time.perf_counter() - start
+    if proc.returncode != 0:
+        raise RuntimeError('the analysis failed with the exit code {code}'.format(code=proc.returncode))
+    return {
+        'seconds': elapsed,
+        'cpu_seconds': rusage.ru_utime + rusage.ru_stime,
+        'peak_rss_mb': rusage.ru_maxrss / 1024
+    }
+
+
+def timed(stage_times, stage, fn, *args):
+    start = time.perf_counter()
+    res = fn(*args)
+    stage_times[stage] = time.perf_counter() - start
+    return res
+
+
+def measure_stages(data_dir, api):
+    from analysis_app import AnalysisApp
+    from kbc_tools import read_csv, batch_request, csv_writer
+
+    os.environ['KBC_PROJECTID'] = BENCH_PROJECT_ID
+    app = AnalysisApp(data_dir=data_dir)
+    req = app.get_request()
+    stage_times = {}
+
+    with open(app.params.source_tab_path, 'r', encoding='utf-8') as in_tab:
+        docs = timed(stage_times, 'read', lambda: [app.row_to_doc(row) for row in read_csv(in_tab)])
+    batches = timed(stage_times, 'batch', lambda: [batch for _, batch in app.doc_batch_stream(iter(docs))])
+    bodies = timed(stage_times, 'encode_request', lambda: [json.dumps(batch_request(batch, req)) for batch in batches])
+    responses = ['[' + ', '.join(api.analyze(doc) for doc in batch) + ']' for batch in batches]
+    analyses = timed(stage_times, 'decode_response', lambda: [
+        doc_analysis for res in responses for doc_analysis in json.loads(res)
+    ])
+    items = [(doc_analysis, app.get_doc_id_values(doc_analysis)) for doc_analysis in analyses]
+
+    for table in app.get_output_plan():
+        flatten = getattr(app, table.flatten)
+        rows = timed(stage_times, 'flatten ' + table.filename, lambda: [
+            row for doc_analysis, id_values in items for row in flatten(doc_analysis, id_values)
+        ])
+        writer = csv_writer(io.StringIO(), fields=getattr(app, table.fields)())
+        timed(stage_times, 'write ' + table.filename, writer.writerows, rows)
+
+    request_bytes = sum(map(len, bodies))
+    response_bytes = sum(len(res.encode('utf-8')) for res in responses)
+    return stage_times, len(docs), request_bytes, response_bytes
+
+
+def main():
+    parser = argparse.ArgumentParser(description='run the whole analysis against a local mock of the analysis API')
+    parser.add_argument('--count', type=int, default=5000, help='the number of documents in the input table')
+    parser.add_argument('--text-length', type=int, default=400, help='the mean text length of the documents')
+    parser.add_argument('--length-distribution', choices=LENGTH_DISTRIBUTIONS, default='lognormal')
+    parser.add_argument('--latency', type=float, default=0.05, help='the minimal response time of the API in seconds')
+    parser.add_argument('--latency-jitter', type=float, default=0.02, help='the mean random addition to the latency')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='the probability of a 503 response')
+    parser.add_argument('--response-scale', type=float, default=1.0, help='the relative size of the analyses')
+    parser.add_argument('--doc-batch-size', type=int, nargs='+', default=[12],
+                        help='the "doc_batch_size" values to compare')
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 4, 8],
+                        help='the "client_thread_count" values to compare')
+    parser.add_argument('--analysis-types', nargs='*', default=[], help='the analysis types, all by default')
+    parser.add_argument('--advanced', type=json.loads, default={},
+                        help='other advanced parameters as a JSON object, e.g. \'{"engine": "async"}\'')
+    parser.add_argument('--no-stages', action='store_true', help='skip the measurement of the individual stages')
+    parser.add_argument('--data-dir', help='keep the benchmark data in this directory instead of a temporary one')
+    parser.add_argument('--verbose', action='store_true', help='show the output of the analysis')
+    args = parser.parse_args()
+
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix='bench-app-')
+    try:
+        input_chars = prepare_data_dir(data_dir, count=args.count, text_length=args.text_length,
+                                       distribution=args.length_distribution)
+        print('{n} documents with {ch} characters in "{path}"'.format(n=args.count, ch=input_chars, path=data_dir))
+
+        with MockApi(latency=args.latency, latency_jitter=args.latency_jitter, error_rate=args.error_rate,
+                     response_scale=args.response_scale) as api:
+            print('{batch:>10} {threads:>8} {secs:>9} {docs:>10} {chars:>12} {cpu:>9} {rss:>9} {reqs:>9}'.format(
+                batch='batch', threads='threads', secs='seconds', docs='docs/s', chars='chars/s', cpu='cpu s',
+                rss='rss MB', reqs='requests'))
+            for doc_batch_size, threads in itertools.product(args.doc_batch_size, args.threads):
+                advanced = dict(args.advanced, doc_batch_size=doc_batch_size, client_thread_count=threads)
+                write_config(data_dir, url=api.url, analysis_types=args.analysis_types, advanced=advanced)
+                clean_outputs(data_dir)
+                requests_before = api.stats()['requests']
+                res = run_app(data_dir, verbose=args.verbose)
+                usage = read_usage(data_dir)
+                print('{batch:>10} {threads:>8} {secs:>9.2f} {docs:>10.0f} {chars:>12.0f} {cpu:>9.2f} {rss:>9.1f} '
+                      '{reqs:>9}'.format(
+                    batch=doc_batch_size, threads=threads, secs=res['seconds'],
+                    docs=usage['documents'] / res['seconds'], chars=usage['characters'] / res['seconds'],
+                    cpu=res['cpu_seconds'], rss=res['peak_rss_mb'], reqs=api.stats()['requests'] - requests_before))
+                sys.stdout.flush()
+
+            if not args.no_stages:
+                stage_times, doc_count, request_bytes, response_bytes = measure_stages(data_dir, api)
+                print('\n{stage:<48} {secs:>9} {us:>10}'.format(stage='stage', secs='seconds', us='us/doc'))
+                for stage, secs in stage_times.items():
+                    print('{stage:<48} {secs:>9.3f} {us:>10.1f}'.format(
+                        stage=stage, secs=secs, us=1e6 * secs / max(1, doc_count)))
+                print('{req:.1f} MB sent and {res:.1f} MB received'.format(
+                    req=request_bytes / 2 ** 20, res=response_bytes / 2 ** 20))
+    finally:
+        if not args.data_dir:
+            shutil.rmtree(data_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+# coding=utf-8
+# Python 3
+
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from kbc_tools import make_serializer, deserialize_data, train_dictionary, CODEC_PICKLE_BZ2, CODEC_JSON_ZLIB, CODEC_JSON_ZSTD
+from synthetic import make_analyses
+
+
+def load_analyses(path):
+    with open(path, 'r', encoding='utf-8') as analyses_file:
+        return [json.loads(line) for line in analyses_file if line.strip()]
+
+
+def bench_codec(analyses, codec, dictionary=None):
+    serialize = make_serializer(codec, dictionary)
+    start = time.process_time()
+    values = [serialize(obj) for obj in analyses]
+    ser_time = time.process_time() - start
+
+    start = time.process_time()
+    for value in values:
+        deserialize_data(value, dictionaries=[dictionary] if dictionary else ())
+    deser_time = time.process_time() - start
+
+    return {
+        'ser_us_per_doc': 1e6 * ser_time / len(analyses),
+        'deser_us_per_doc': 1e6 * deser_time / len(analyses),
+        'bytes_per_doc': sum(map(len, values)) / len(analyses)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='compare the codecs of the full analysis output')
+    parser.add_argument('--analyses', help='JSON lines file with document analyses, synthetic ones are used if missing')
+    parser.add_argument('--count', type=int, default=2000, help='the number of synthetic analyses')
+    parser.add_argument('--text-length', type=int, default=400, help='the text length of the synthetic analyses')
+    parser.add_argument('--train-samples', type=int, default=200, help='the number of analyses to train a dictionary on')
+    parser.add_argument('--save-dictionary', help='write the dictionary trained for the json-zlib codec to this file')
+    args = parser.parse_args()
+
+    if args.analyses:
+        analyses = load_analyses(args.analyses)
+    else:
+        analyses = make_analyses(args.count, text_length=args.text_length, mentions=True)
+    train, test = analyses[:args.train_samples], analyses[args.train_samples:] or analyses
+
+    variants = [(CODEC_PICKLE_BZ2, None), (CODEC_JSON_ZLIB, None)]
+    zlib_dictionary = train_dictionary(train, codec=CODEC_JSON_ZLIB)
+    variants.append((CODEC_JSON_ZLIB, zlib_dictionary))
+    try:
+        zstd_dictionary = train_dictionary(train, codec=CODEC_JSON_ZSTD)
+        variants += [(CODEC_JSON_ZSTD, None), (CODEC_JSON_ZSTD, zstd_dictionary)]
+    except ValueError as e:
+        print('skipping the {codec} codec: {e}'.format(codec=CODEC_JSON_ZSTD, e=e), file=sys.stderr)
+
+    print('{codec:<22} {ser:>12} {deser:>12} {size:>12}'.format(
+        codec='codec', ser='ser us/doc', deser='deser us/doc', size='bytes/doc'))
+    for codec, dictionary in variants:
+        res = bench_codec(test, codec, dictionary)
+        name = codec + (' +dict' if dictionary else '')
+        print('{codec:<22} {ser_us_per_doc:>12.1f} {deser_us_per_doc:>12.1f} {bytes_per_doc:>12.0f}'.format(codec=name, **res))
+
+    if args.save_dictionary:
+        with open(args.save_dictionary, 'wb') as dictionary_file:
+            dictionary_file.write(zlib_dictionary)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+# coding=utf-8
+# Python 3
+
+import argparse
+import csv
+import io
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from kbc_tools import csv_writer
+from output_rows import (doc_rows, snt_rows, ent_rows, rel_rows, DOC_COLUMNS, SNT_COLUMNS, ENT_COLUMNS, REL_COLUMNS,
+                         SENTIMENT_COLUMNS)
+from synthetic import make_analyses
+
+
+# the previous flattening into a dict per row written by csv.DictWriter, kept to compare with
+def dict_sentiment(res, obj):
+    if 'sentiment' in obj:
+        if obj['sentiment']['polarity'] > 0: label = 'positive'
+        elif obj['sentiment']['polarity'] < 0: label = 'negative'
+        else: label = 'neutral'
+        res['sentimentValue'] = obj['sentiment']['value']
+        res['sentimentPolarity'] = obj['sentiment']['polarity']
+        res['sentimentLabel'] = label
+        res['sentimentDetailedLabel'] = obj['sentiment']['label']
+    else:
+        for field in SENTIMENT_COLUMNS:
+            res[field] = None
+
+
+def dict_doc_rows(doc_analysis, doc_ids_vals):
+    res = {'language': doc_analysis['language'], 'usedChars': doc_analysis['usedChars']}
+    for id_col, val in doc_ids_vals:
+        res[id_col] = val
+    dict_sentiment(res, doc_analysis)
+    yield res
+
+
+def dict_snt_rows(doc_analysis, doc_ids_vals):
+    for index, snt in enumerate(doc_analysis.get('sentences', ())):
+        res = {'index': index, 'segment': snt['segment'], 'text': snt['text']}
+        dict_sentiment(res, snt)
+        for id_col, val in doc_ids_vals:
+            res[id_col] = val
+        yield res
+
+
+def dict_ent_rows(doc_analysis, doc_ids_vals):
+    for ent in doc_analysis.get('entities', ()):
+        res = {'type': ent['type'], 'text': ent['text'], 'score': ent['score'], 'entityUid': ent.get('uid')}
+        dict_sentiment(res, ent)
+        for id_col, val in doc_ids_vals:
+            res[id_col] = val
+        yield res
+
+
+def dict_rel_rows(doc_analysis, doc_ids_vals):
+    for rel in doc_analysis.get('relations', ()):
+        res = {
+            'type': rel['type'], 'name': rel['name'], 'negated': rel['negated'],
+            'subject': rel.get('subjectName'), 'subjectType': rel.get('subjectType'),
+            'subjectUid': rel.get('subjectUid'), 'object': rel.get('objectName'),
+            'objectType': rel.get('objectType'), 'objectUid': rel.get('objectUid')
+        }
+        dict_sentiment(res, rel)
+        for id_col, val in doc_ids_vals:
+            res[id_col] = val
+        yield res
+
+
+TABLES = [
+    ('documents', DOC_COLUMNS, dict_doc_rows, doc_rows),
+    ('sentences', SNT_COLUMNS, dict_snt_rows, snt_rows),
+    ('entities', ENT_COLUMNS, dict_ent_rows, ent_rows),
+    ('relations', REL_COLUMNS, dict_rel_rows, rel_rows)
+]
+
+
+def write_dicts(analyses, id_cols, columns, flatten):
+    output = io.StringIO()
+    writer = csv.DictWriter(output, fieldnames=id_cols + columns, dialect='kbc')
+    writer.writeheader()
+    for doc_analysis in analyses:
+        writer.writerows(flatten(doc_analysis, list(zip(id_cols, json.loads(doc_analysis['id'])))))
+    return output.getvalue()
+
+
+def write_tuples(analyses, id_cols, columns, flatten):
+    output = io.StringIO()
+    writer = csv_writer(output, fields=id_cols + columns)
+    for doc_analysis in analyses:
+        writer.writerows(flatten(doc_analysis, tuple(json.loads(doc_analysis['id']))))
+    return output.getvalue()
+
+
+def best_time(repeat, fn, *args):
+    best, res = None, None
+    for _ in range(repeat):
+        start = time.process_time()
+        res = fn(*args)
+        elapsed = time.process_time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, res
+
+
+def main():
+    parser = argparse.ArgumentParser(description='compare the dict and the tuple flattening of the output rows')
+    parser.add_argument('--count', type=int, default=500, help='the number of synthetic analyses')
+    parser.add_argument('--text-length', type=int, default=6000,
+                        help='the text length of the synthetic analyses, there is an entity per 60 characters')
+    parser.add_argument('--id-cols', type=int, default=2, help='the number of ID columns')
+    parser.add_argument('--repeat', type=int, default=3, help='the best of this many runs is reported')
+    args = parser.parse_args()
+
+    id_cols = ['id{n}'.format(n=n) for n in range(args.id_cols)]
+    analyses = make_analyses(args.count, text_length=args.text_length)
+    for n, doc_analysis in enumerate(analyses):
+        doc_analysis['id'] = json.dumps([str(n)] + ['key-{n}'.format(n=n)] * (args.id_cols - 1))
+
+    print('{table:<12} {rows:>10} {dicts:>12} {tuples:>12} {speedup:>8}'.format(
+        table='table', rows='rows', dicts='dict us/doc', tuples='tuple us/doc', speedup='speedup'))
+    total_dicts, total_tuples = 0.0, 0.0
+    for table, columns, dict_flatten, tuple_flatten in TABLES:
+        dict_secs, dict_csv = best_time(args.repeat, write_dicts, analyses, id_cols, columns, dict_flatten)
+        tuple_secs, tuple_csv = best_time(args.repeat, write_tuples, analyses, id_cols, columns, tuple_flatten)
+        if dict_csv != tuple_csv:
+            raise RuntimeError('the "{table}" table differs between the two flatteners'.format(table=table))
+        total_dicts += dict_secs
+        total_tuples += tuple_secs
+        print('{table:<12} {rows:>10} {dicts:>12.1f} {tuples:>12.1f} {speedup:>7.2f}x'.format(
+            table=table, rows=dict_csv.count('\n') - 1, dicts=1e6 * dict_secs / args.count,
+            tuples=1e6 * tuple_secs / args.count, speedup=dict_secs / tuple_secs))
+    print('{table:<12} {rows:>10} {dicts:>12.1f} {tuples:>12.1f} {speedup:>7.2f}x'.format(
+        table='all', rows='', dicts=1e6 * total_dicts / args.count, tuples=1e6 * total_tuples / args.count,
+        speedup=total_dicts / total_tuples))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+# coding=utf-8
+# Python 3
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+import zlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from kbc_tools import read_csv, read_csv_projected, read_csv_mapped, read_csv_fieldnames
+from analysis_app import row_to_doc
+from synthetic import write_input_table
+
+ID_COLS, TEXT_COLS, TITLE_COLS, LEAD_COLS = ['id'], ['text'], ['title'], []
+INPUT_COLS = ID_COLS + TEXT_COLS + TITLE_COLS
+SAMPLE_ROWS = 1000
+
+
+def dict_docs(path):
+    with open(path, 'r', encoding='utf-8') as in_tab:
+        fieldnames = read_csv_fieldnames(in_tab)
+        for row in read_csv(in_tab, fieldnames):
+            yield row_to_doc(row, ID_COLS, TEXT_COLS, TITLE_COLS, LEAD_COLS)
+
+
+def projected_docs(path):
+    with open(path, 'r', encoding='utf-8') as in_tab:
+        fieldnames = read_csv_fieldnames(in_tab)
+        for row in read_csv_projected(in_tab, INPUT_COLS, fieldnames):
+            yield row_to_doc(row, ID_COLS, TEXT_COLS, TITLE_COLS, LEAD_COLS)
+
+
+def mapped_docs(path):
+    index_columns = [[INPUT_COLS.index(col) for col in cols] for cols in (ID_COLS, TEXT_COLS, TITLE_COLS, LEAD_COLS)]
+    for row in read_csv_mapped(path, INPUT_COLS):
+        yield row_to_doc(row, *index_columns)
+
+
+READERS = [
+    ('read_csv', dict_docs),
+    ('read_csv_projected', projected_docs),
+    ('read_csv_mapped', mapped_docs)
+]
+
+
+def consume(docs):
+    # the documents are not kept so that multi-GB tables fit in the memory, a checksum is compared instead
+    count, checksum = 0, 0
+    for doc in docs:
+        count += 1
+        checksum = zlib.crc32(doc['text'].encode('utf-8'), zlib.crc32(doc['id'].encode('utf-8'), checksum))
+    return count, checksum
+
+
+def warm_page_cache(path):
+    with open(path, 'rb') as input_file:
+        while input_file.read(16 * 1024 * 1024):
+            pass
+
+
+def write_table(path, args):
+    if args.size_mb:
+        # the number of rows is estimated from the size of a small sample of the table
+        write_input_table(path, SAMPLE_ROWS, text_length=args.text_length, extra_columns=args.extra_columns)
+        count = int(args.size_mb * 1024 * 1024 * SAMPLE_ROWS / os.path.getsize(path))
+    else:
+        count = args.count
+    write_input_table(path, count, text_length=args.text_length, extra_columns=args.extra_columns)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='compare the readers of the input table on a wide table')
+    parser.add_argument('--count', type=int, default=50000, help='the number of rows of the input table')
+    parser.add_argument('--size-mb', type=float, default=0,
+                        help='the size of the input table in MB, it overrides the number of rows')
+    parser.add_argument('--text-length', type=int, default=400, help='the text length of the rows')
+    parser.add_argument('--extra-columns', type=int, default=50,
+                        help='the number of columns which are not used by the analysis')
+    parser.add_argument('--input', help='an existing table with the id, title and text columns to read instead')
+    parser.add_argument('--repeat', type=int, default=3, help='the best of this many runs is reported')
+    args = parser.parse_args()
+
+    tmp_dir = None
+    if args.input:
+        path = args.input
+    else:
+        tmp_dir = tempfile.mkdtemp(prefix='bench-reader-')
+        path = os.path.join(tmp_dir, 'input.csv')
+        write_table(path, args)
+    try:
+        size_mb = os.path.getsize(path) / (1024 * 1024)
+        print('{path}: {size:.1f} MB'.format(path=path, size=size_mb))
+        warm_page_cache(path)
+
+        print('{reader:<20} {rows:>10} {secs:>9} {rate:>12} {mbs:>9} {speedup:>8}'.format(
+            reader='reader', rows='rows', secs='seconds', rate='rows/s', mbs='MB/s', speedup='speedup'))
+        baseline, expected = None, None
+        for name, docs in READERS:
+            best, res = None, None
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                res = consume(docs(path))
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            if expected is None:
+                baseline, expected = best, res
+            elif res != expected:
+                raise RuntimeError('the documents of "{reader}" differ from the "read_csv" ones'.format(reader=name))
+            print('{reader:<20} {rows:>10} {secs:>9.2f} {rate:>12.0f} {mbs:>9.1f} {speedup:>7.2f}x'.format(
+                reader=name, rows=res[0], secs=best, rate=res[0] / best, mbs=size_mb / best, speedup=baseline / best))
+    finally:
+        if tmp_dir:
+            shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+# coding=utf-8
+# Python 3
+
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from bench_app import prepare_data_dir, write_config, clean_outputs, run_app, SRC_DIR
+from mock_api import MockApi
+
+STARTUP_BUDGET_MS = 250
+IMPORT_TIME_TOP = 10
+
+
+def measure_import(module):
+    code = 'import time; start = time.perf_counter(); import {module}; print(time.perf_counter() - start)'.format(
+        module=module)
+    start = time.perf_counter()
+    res = subprocess.run([sys.executable, '-c', code], cwd=SRC_DIR, check=True, stdout=subprocess.PIPE,
+                         universal_newlines=True)
+    return time.perf_counter() - start, float(res.stdout)
+
+
+def slowest_imports(module, count=IMPORT_TIME_TOP):
+    res = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import {module}'.format(module=module)],
+                         cwd=SRC_DIR, check=True, stderr=subprocess.PIPE, universal_newlines=True)
+    # "import time: <self us> | <cumulative us> | <indented module name>", only the direct imports of the module
+    imports = []
+    for line in res.stderr.splitlines():
+        parts = line.split('|')
+        if len(parts) == 3 and parts[2].startswith('   ') and not parts[2].startswith('    '):
+            imports.append((int(parts[1]), parts[2].strip()))
+    return sorted(imports, reverse=True)[:count]
+
+
+def read_startup(data_dir):
+    with open(os.path.join(data_dir, 'out', 'metrics.json'), 'r', encoding='utf-8') as metrics_file:
+        return json.load(metrics_file)['stage_seconds'].get('startup', 0.0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='measure the startup time of the component on a tiny input table')
+    parser.add_argument('--repeat', type=int, default=5, help='the median of this many runs is reported')
+    parser.add_argument('--count', type=int, default=10, help='the number of documents in the input table')
+    parser.add_argument('--budget-ms', type=float, default=STARTUP_BUDGET_MS,
+                        help='the allowed startup time, the imports and the configuration, in milliseconds')
+    args = parser.parse_args()
+
+    interpreter = statistics.median(measure_import('sys')[0] for _ in range(args.repeat))
+    imports = [measure_import('analysis_app')[1] for _ in range(args.repeat)]
+    print('{label:<32} {ms:>9.1f} ms'.format(label='interpreter', ms=1e3 * interpreter))
+    print('{label:<32} {ms:>9.1f} ms'.format(label='import analysis_app', ms=1e3 * statistics.median(imports)))
+    for cumulative_us, module in slowest_imports('analysis_app'):
+        print('  {module:<30} {ms:>9.1f} ms'.format(module=module, ms=cumulative_us / 1e3))
+
+    data_dir = tempfile.mkdtemp(prefix='bench-startup-')
+    try:
+        prepare_data_dir(data_dir, count=args.count, text_length=200, distribution='fixed')
+        with MockApi(latency=0.0) as api:
+            write_config(data_dir, url=api.url, analysis_types=[], advanced={})
+            runs, startups = [], []
+            for _ in range(args.repeat):
+                clean_outputs(data_dir)
+                runs.append(run_app(data_dir)['seconds'])
+                startups.append(read_startup(data_dir))
+    finally:
+        shutil.rmtree(data_dir)
+
+    startup = statistics.median(startups)
+    print('{label:<32} {ms:>9.1f} ms'.format(label='startup (imports, configuration)', ms=1e3 * startup))
+    print('{label:<32} {ms:>9.1f} ms'.format(label='whole run', ms=1e3 * statistics.median(runs)))
+    if 1e3 * startup > args.budget_ms:
+        print('the startup exceeds the budget of {budget:.0f} ms'.format(budget=args.budget_ms))
+        sys.exit(1)
+    print('the startup is within the budget of {budget:.0f} ms'.format(budget=args.budget_ms))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+# coding=utf-8
+# Python 3
+
+import argparse
+import json
+import random
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from synthetic import make_analysis
+
+ANALYSIS_PATH = '/keboola/v2/analysis'
+LENGTH_BUCKET = 100
+
+
+# a local stub of the analysis endpoint answering with synthetic analyses, the response time is the latency
+# plus an exponentially distributed jitter, the response_scale multiplies the size of the analyses
+class MockApi:
+
+    def __init__(self, *, port=0, latency=0.05, latency_jitter=0.0, error_rate=0.0, response_scale=1.0, seed=42):
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.response_scale = response_scale
+        self.rnd = random.Random(seed)
+        self.lock = threading.Lock()
+        self.templates = {}
+        self.requests = 0
+        self.errors = 0
+        self.bytes_received = 0
+        self.bytes_sent = 0
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), self.make_handler())
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, name='mock-api', daemon=True)
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return 'http://{host}:{port}{path}'.format(host=host, port=port, path=ANALYSIS_PATH)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def get_template(self, length):
+        # generating the analyses would make the stub the bottleneck, they are shared by texts of similar length
+        bucket = length // LENGTH_BUCKET
+        with self.lock:
+            if bucket not in self.templates:
+                text_length = max(1, int((bucket + 0.5) * LENGTH_BUCKET * self.response_scale))
+                template = make_analysis(self.rnd, None, text_length=text_length)
+                del template['id'], template['usedChars']
+                self.templates[bucket] = json.dumps(template, ensure_ascii=False)[:-1]
+            return self.templates[bucket]
+
+    def analyze(self, doc):
+        used_chars = sum(len(doc.get(key) or '') for key in ('title', 'lead', 'text'))
+        # the template is a JSON object without the closing brace, the ID and used characters are appended to it
+        return '{template}, "id": {id}, "usedChars": {chars}}}'.format(
+            template=self.get_template(used_chars), id=json.dumps(doc['id']), chars=used_chars)
+
+    def respond(self, body):
+        with self.lock:
+            self.requests += 1
+            self.bytes_received += len(body)
+            failed = self.rnd.random() < self.error_rate
+            delay = self.latency
+            if self.latency_jitter:
+                delay += self.rnd.expovariate(1.0 / self.latency_jitter)
+        time.sleep(delay)
+        if failed:
+            with self.lock:
+                self.errors += 1
+            return 503, b'{"message": "the mock API is overloaded"}'
+
+        docs = json.loads(body.decode('utf-8'))['documents']
+        data = '[' + ', '.join(self.analyze(doc) for doc in docs) + ']'
+        res = data.encode('utf-8')
+        with self.lock:
+            self.bytes_sent += len(res)
+        return 200, res
+
+    def stats(self):
+        with self.lock:
+            return {
+                'requests': self.requests,
+                'errors': self.errors,
+                'bytes_received': self.bytes_received,
+                'bytes_sent': self.bytes_sent
+            }
+
+    def make_handler(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                if self.path != ANALYSIS_PATH:
+                    code, res = 404, b'{"message": "not found"}'
+                else:
+                    code, res = api.respond(body)
+                self.send_response(code)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(res)))
+                self.end_headers()
+                self.wfile.write(res)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description='run a local stub of the analysis API')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0.05, help='the minimal response time in seconds')
+    parser.add_argument('--latency-jitter', type=float, default=0.0, help='the mean random addition to the latency')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='the probability of a 503 response')
+    parser.add_argument('--response-scale', type=float, default=1.0, help='the relative size of the analyses')
+    args = parser.parse_args()
+
+    api = MockApi(port=args.port, latency=args.latency, latency_jitter=args.latency_jitter,
+                  error_rate=args.error_rate, response_scale=args.response_scale)
+    print('serving the mock analysis API at {url}'.format(url=api.url))
+    api.server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+# coding=utf-8
+# Python 3
+
+import csv
+import random
+
+WORDS = ('the', 'hotel', 'room', 'was', 'clean', 'and', 'staff', 'very', 'friendly', 'but', 'breakfast',
+         'not', 'good', 'at', 'all', 'we', 'stayed', 'in', 'London', 'for', 'three', 'nights', 'price', 'great')
+ENTITY_TYPES = ('person', 'organization', 'location', 'product', 'tag', 'date')
+LENGTH_DISTRIBUTIONS = ('fixed', 'uniform', 'lognormal')
+
+
+def make_text(rnd, length):
+    words = []
+    size = 0
+    while size < length:
+        word = rnd.choice(WORDS)
+        words.append(word)
+        size += len(word) + 1
+    return ' '.join(words)[:length]
+
+
+def make_sentiment(rnd):
+    value = round(rnd.uniform(-1.0, 1.0), 3)
+    polarity = 1 if value > 0.2 else -1 if value < -0.2 else 0
+    return {'value': value, 'polarity': polarity, 'label': ['negative', 'neutral', 'positive'][polarity + 1]}
+
+
+def make_analysis(rnd, doc_id, *, text_length=400, mentions=False):
+    text = make_text(rnd, text_length)
+    sentences = [s for s in (text[i:i + 80] for i in range(0, len(text), 80))]
+    analysis = {
+        'id': doc_id,
+        'language': 'en',
+        'usedChars': len(text),
+        'sentiment': make_sentiment(rnd),
+        'sentences': [
+            {'segment': 'text', 'text': snt, 'sentiment': make_sentiment(rnd)} for snt in sentences
+        ],
+        'entities': [
+            {
+                'type': rnd.choice(ENTITY_TYPES), 'text': make_text(rnd, rnd.randint(4, 20)),
+                'score': round(rnd.random(), 3), 'uid': 'G{n}'.format(n=rnd.randint(1, 10 ** 6)),
+                'sentiment': make_sentiment(rnd)
+            } for _ in range(max(1, text_length // 60))
+        ],
+        'relations': [
+            {
+                'type': rnd.choice(('VERB', 'ATTR')), 'name': rnd.choice(WORDS), 'negated': rnd.random() < 0.1,
+                'subjectName': rnd.choice(WORDS), 'subjectType': 'person', 'subjectUid': None,
+                'objectName': rnd.choice(WORDS), 'objectType': 'product', 'objectUid': None,
+                'sentiment': make_sentiment(rnd)
+            } for _ in range(max(1, text_length // 120))
+        ]
+    }
+    if mentions:
+        for ent in analysis['entities']:
+            ent['mentions'] = [{'text': ent['text'], 'tokenIds': [rnd.randint(0, 500)]}]
+    return analysis
+
+
+def make_analyses(count, *, text_length=400, mentions=False, seed=42):
+    rnd = random.Random(seed)
+    return [make_analysis(rnd, '["{n}"]'.format(n=n), text_length=text_length, mentions=mentions) for n in range(count)]
+
+
+def make_text_length(rnd, mean, distribution='fixed'):
+    if distribution == 'uniform':
+        return rnd.randint(1, 2 * mean)
+    if distribution == 'lognormal':
+        # a long tail of a few very long texts, the median is about a half of the mean
+        return max(1, int(rnd.lognormvariate(0, 1.2) * mean / 2.05))
+    return mean
+
+
+def write_input_table(path, count, *, text_length=400, distribution='fixed', seed=42, extra_columns=0):
+    # the extra columns, e.g. of a wide table exported from a CRM, are not used by the analysis
+    rnd = random.Random(seed)
+    chars = 0
+    extra_names = ['attr{n}'.format(n=n) for n in range(extra_columns)]
+    with open(path, 'w', encoding='utf-8', newline='') as input_file:
+        writer = csv.writer(input_file, lineterminator='\n', quoting=csv.QUOTE_ALL)
+        writer.writerow(['id', 'title', 'text'] + extra_names)
+        for n in range(count):
+            text = make_text(rnd, make_text_length(rnd, text_length, distribution))
+            title = make_text(rnd, 40)
+            extra = ['{value:.6f}'.format(value=rnd.random()) for _ in extra_names]
+            writer.writerow([str(n), title, text] + extra)
+            chars += len(title) + len(text)
+    return chars
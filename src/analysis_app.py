@@ -1,25 +1,62 @@
 # coding=utf-8
 # Python 3
 
+import contextlib
+import copy
+import functools
+import hashlib
 import itertools
 import json
 import os
 import sys
+import threading
+import time
 
-import requests
+from collections import defaultdict, deque, namedtuple, OrderedDict
 
-from concurrent.futures import ThreadPoolExecutor
-
-from keboola import docker
-
-from kbc_tools import read_csv, csv_writer, slice_stream, make_batch_request, parallel_map, serialize_data
+from kbc_tools import (read_csv, read_csv_projected, read_csv_tuples, read_csv_mapped, read_csv_header, read_csv_fieldnames, csv_shards, read_csv_shard, slice_stream, make_batch_request,
+                       parallel_map, make_serializer, batch_request_size, DocBatcher, TableWriter, open_output,
+                       flushed_size, write_json_atomic, RetryPolicy, ConcurrencyLimiter, MemoryBudget, DeadLetterWriter,
+                       read_dead_letters, doc_request_size, plan_batch_requests, print_skipped_doc, MAX_REQ_SIZE, MAX_RETRIES, RETRY_BACKOFF, RETRY_MAX_BACKOFF,
+                       RETRY_AFTER_LIMIT, CSV_SHARD_SIZE, WRITER_QUEUE_SIZE, OUTPUT_BUFFER_SIZE, CODECS, CODEC_PICKLE_BZ2)
+from metrics import Metrics
+from result_cache import ResultCache, CACHE_MAX_ENTRIES, CACHE_TTL_DAYS
+from fingerprint_index import FingerprintIndex
+from language_id import LanguageDetector, LANGUAGES
+from text_prep import normalize_text, split_text, truncate_text
+from output_rows import (doc_rows, snt_rows, ent_rows, rel_rows, DOC_COLUMNS, SNT_COLUMNS, ENT_COLUMNS, REL_COLUMNS,
+                         FULL_COLUMNS)
+from cost_estimate import CostEstimate, PROJECTED_THREAD_COUNTS
+from dedup_index import (DedupIndex, DEDUP_MEMORY_ENTRIES, PENDING as DEDUP_PENDING, FAILED as DEDUP_FAILED,
+                         SKIPPED as DEDUP_SKIPPED)
 
 BASE_URL = 'https://api.geneea.com/keboola/v2/analysis'
 BETA_URL = 'https://beta-api.geneea.com/keboola/v2/analysis'
 DOC_BATCH_SIZE = 12
 THREAD_COUNT = 1
+BATCHING_MODES = frozenset(['size', 'count'])
+CHECKPOINT_INTERVAL = 10000
+INCREMENTAL_INDEX_PATH = 'incremental-index.sqlite'
+ENGINES = frozenset(['threads', 'async'])
+ASYNC_MAX_IN_FLIGHT = 256
+ASYNC_CONNECTION_LIMIT = 64
+# a rough estimate of the memory used by a batch per byte of its texts: the documents, the request body,
+# the response and the decoded analyses until they are written by all table writers
+MEMORY_PER_REQUEST_BYTE = 10
+OVERSIZED_DOCS_MODES = frozenset(['skip', 'truncate', 'chunk'])
 
 ANALYSIS_TYPES = frozenset(['sentiment', 'entities', 'tags', 'relations'])
+OUTPUT_FORMATS = frozenset(['csv', 'parquet'])
+
+# the types of the output columns in the typed output formats, the other columns are strings
+COLUMN_TYPES = {
+    'sentimentValue': 'float',
+    'sentimentPolarity': 'int',
+    'usedChars': 'int',
+    'index': 'int',
+    'score': 'float',
+    'negated': 'bool'
+}
 
 OUT_TAB_DOC = 'analysis-result-documents.csv'
 OUT_TAB_SNT = 'analysis-result-sentences.csv'
@@ -27,8 +64,70 @@ OUT_TAB_ENT = 'analysis-result-entities.csv'
 OUT_TAB_REL = 'analysis-result-relations.csv'
 OUT_TAB_FULL = 'analysis-result-full.csv'
 
+# output tables in the order they are written, each with the names of the app methods providing
+# its columns and rows, the extra primary key columns and a predicate deciding whether it is written at all
+OutputTable = namedtuple('OutputTable', ['filename', 'meta_filename', 'key_cols', 'fields', 'flatten', 'enabled'])
+
+OUTPUT_TABLES = [
+    OutputTable(OUT_TAB_DOC, 'documents-tab.json', [], 'get_doc_tab_fields', 'analysis_to_doc_result',
+                lambda params: True),
+    OutputTable(OUT_TAB_SNT, 'sentences-tab.json', ['index'], 'get_snt_tab_fields', 'analysis_to_snt_result',
+                lambda params: not params.analysis_types or 'sentiment' in params.analysis_types),
+    OutputTable(OUT_TAB_ENT, 'entities-tab.json', ['type', 'text'], 'get_ent_tab_fields', 'analysis_to_ent_result',
+                lambda params: not params.analysis_types or bool({'entities', 'tags'} & params.analysis_types)),
+    OutputTable(OUT_TAB_REL, 'relations-tab.json', ['type', 'name', 'negated', 'subject', 'object'],
+                'get_rel_tab_fields', 'analysis_to_rel_result',
+                lambda params: not params.analysis_types or 'relations' in params.analysis_types),
+    OutputTable(OUT_TAB_FULL, 'full-tab.json', [], 'get_full_tab_fields', 'analysis_to_full_result',
+                lambda params: params.full_analysis_output)
+]
+
+# the documents sent in one API request, the cached results and the duplicates which are not sent at all
+class DocBatch(namedtuple('DocBatch', ['docs', 'cache_keys', 'hits', 'dedup_keys', 'dups', 'memory', 'language',
+                                       'empty_count'])):
+    __slots__ = ()
+
+    @property
+    def row_count(self):
+        return len(self.docs) + len(self.hits) + len(self.dups) + self.empty_count
+
+# the dead letter of the requests, the failed chunks are skipped, the app writes their whole documents instead;
+# the chunks of a batch are in the chunk_docs until the main thread gets the result of the batch
+class ChunkedDeadLetter:
+
+    def __init__(self, dead_letter, chunk_docs):
+        self.dead_letter = dead_letter
+        self.chunk_docs = chunk_docs
+
+    def write(self, batch):
+        docs = [doc for doc in batch if doc['id'] not in self.chunk_docs]
+        if docs:
+            self.dead_letter.write(docs)
+
+# the dead letter of the requests with checkpoints, the failed documents are written only when the main thread gets
+# the result of their batch, so the dead letter at a checkpoint holds no documents of the batches after it
+class DeferredDeadLetter:
+
+    def __init__(self, dead_letter):
+        self.dead_letter = dead_letter
+        self.failed = {}
+        self.lock = threading.Lock()
+
+    def write(self, batch):
+        with self.lock:
+            for doc in batch:
+                self.failed[id(doc)] = doc
+
+    def flush(self, docs):
+        with self.lock:
+            failed = [self.failed.pop(id(doc)) for doc in docs if id(doc) in self.failed]
+        if failed:
+            self.dead_letter.write(failed)
+
 META_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'meta')
 META_DESC_KEY = 'KBC.description'
+META_BASETYPE_KEY = 'KBC.datatype.basetype'
+BASETYPES = {'string': 'STRING', 'int': 'INTEGER', 'float': 'FLOAT', 'bool': 'BOOLEAN'}
 
 KBC_STACK_ID_TO_NAME = {
     'connection.keboola.com': 'US',
@@ -36,6 +135,105 @@ KBC_STACK_ID_TO_NAME = {
     'connection.ap-southeast-2.keboola.com': 'AU'
 }
 
+def row_to_doc(row, id_cols, text_cols, title_cols, lead_cols, normalize=False):
+    def join_cols(columns):
+        values = (row[col] for col in columns)
+        if normalize:
+            # the missing fields of short rows are None
+            values = (normalize_text(value) for value in values if value)
+        return '\n\n'.join(value for value in values if value)
+
+    doc = {
+        'id': json.dumps(list(row[id_col] for id_col in id_cols)),
+        'text': join_cols(text_cols)
+    }
+    if title_cols:
+        doc['title'] = join_cols(title_cols)
+    if lead_cols:
+        doc['lead'] = join_cols(lead_cols)
+    return doc
+
+
+@functools.lru_cache(maxsize=None)
+def load_table_meta(meta_filename):
+    # the same descriptions are used by the manifests of all the tables analyzed in one run
+    with open(os.path.join(META_DIR, meta_filename), 'r', encoding='utf-8') as meta_file:
+        return json.load(meta_file)
+
+
+def shard_to_docs(shard, fieldnames, *, path, columns, normalize=False):
+    start, end = shard
+    return [row_to_doc(row, *columns, normalize=normalize) for row in read_csv_shard(path, start, end, fieldnames)]
+
+
+def truncate_doc(doc, max_size):
+    doc = dict(doc)
+    # the title and the lead can take at most a quarter of the limit each, the text gets the rest
+    for key in ('title', 'lead'):
+        if key in doc:
+            doc[key] = truncate_text(doc[key], max_size // 4)
+    doc['text'] = truncate_text(doc['text'], max(0, max_size - doc_request_size(dict(doc, text=''))))
+    return doc
+
+
+def merge_chunk_analyses(doc_id, parts):
+    merged = dict(parts[0], id=doc_id)
+    merged['usedChars'] = sum(int(part['usedChars']) for part in parts)
+    sentiments = [(part['sentiment'], int(part['usedChars'])) for part in parts if 'sentiment' in part]
+    if sentiments:
+        merged['sentiment'] = merge_sentiments(sentiments)
+    list_keys = OrderedDict((key, None) for part in parts for key, value in part.items() if isinstance(value, list))
+    for key in list_keys:
+        # the sentences are indexed by their position, the merged ones are re-indexed when flattened
+        items = [item for part in parts for item in part.get(key, [])]
+        if key in ('entities', 'tags'):
+            items = merge_scored_items(items)
+        elif key == 'relations':
+            relations = OrderedDict()
+            for rel in items:
+                relations.setdefault((rel['type'], rel['name'], rel['negated'], rel.get('subjectName'),
+                                      rel.get('objectName')), rel)
+            items = list(relations.values())
+        merged[key] = items
+    return merged
+
+
+def merge_sentiments(weighted_sentiments):
+    total_weight = sum(weight for _, weight in weighted_sentiments) or 1
+    polarity_weights = defaultdict(int)
+    for sentiment, weight in weighted_sentiments:
+        polarity_weights[sentiment['polarity']] += weight
+    value = sum(sentiment['value'] * weight for sentiment, weight in weighted_sentiments) / total_weight
+    # the prevailing polarity decides, a tie by the mean value, the label is of the largest chunk of that polarity
+    polarity = max(polarity_weights, key=lambda pol: (polarity_weights[pol], pol * value))
+    heaviest, _ = max(((sentiment, weight) for sentiment, weight in weighted_sentiments
+                       if sentiment['polarity'] == polarity), key=lambda item: item[1])
+    return dict(heaviest, value=round(value, 4))
+
+
+def merge_scored_items(items):
+    merged = OrderedDict()
+    sentiments = defaultdict(list)
+    for item in items:
+        key = (item.get('type'), item['text'])
+        if key not in merged:
+            merged[key] = dict(item)
+        else:
+            first = merged[key]
+            if first.get('uid') is None and item.get('uid') is not None:
+                first['uid'] = item['uid']
+            if 'score' in item:
+                first['score'] = max(first.get('score', item['score']), item['score'])
+            if 'mentions' in item:
+                first['mentions'] = first.get('mentions', []) + item['mentions']
+        if 'sentiment' in item:
+            sentiments[key].append((item['sentiment'], 1))
+    for key, item_sentiments in sentiments.items():
+        if len(item_sentiments) > 1:
+            merged[key]['sentiment'] = merge_sentiments(item_sentiments)
+    return list(merged.values())
+
+
 class Params:
 
     def __init__(self, config):
@@ -63,12 +261,64 @@ class Params:
         self.use_beta = params.get('use_beta', False)
 
         advanced_params = self.get_advanced_params()
+        self.batching = advanced_params.get('batching', 'size')
         self.doc_batch_size = int(advanced_params.get('doc_batch_size', DOC_BATCH_SIZE))
+        self.max_batch_docs = int(advanced_params['doc_batch_size']) if 'doc_batch_size' in advanced_params else None
+        self.max_batch_bytes = int(advanced_params.get('max_batch_bytes', MAX_REQ_SIZE))
+        self.adaptive_batching = bool(int(advanced_params.get('adaptive_batching', 0)))
         self.thread_count = int(advanced_params.get('client_thread_count', THREAD_COUNT))
+        self.reader_processes = int(advanced_params.get('reader_processes', 1))
+        self.reader_shard_size = int(advanced_params.get('reader_shard_size', CSV_SHARD_SIZE))
+        self.mapped_input = bool(int(advanced_params.get('mapped_input', 0)))
+        self.engine = advanced_params.get('engine', 'threads')
+        self.ordered_output = bool(int(advanced_params.get('ordered_output', 1)))
+        self.lookahead = int(advanced_params.get('lookahead', 0))
+        self.reorder_buffer = int(advanced_params.get('reorder_buffer', 0))
+        self.async_max_in_flight = int(advanced_params.get('async_max_in_flight', ASYNC_MAX_IN_FLIGHT))
+        self.async_connection_limit = int(advanced_params.get('async_connection_limit', ASYNC_CONNECTION_LIMIT))
+        self.language_detection = advanced_params.get('language_detection', [])
+        self.skip_empty_texts = bool(int(advanced_params.get('skip_empty_texts', 0)))
+        self.normalize_text = bool(int(advanced_params.get('normalize_text', 0)))
+        self.oversized_docs = advanced_params.get('oversized_docs', 'skip')
+        self.max_memory_mb = float(advanced_params.get('max_memory_mb', 0))
+        self.stream_responses = bool(int(advanced_params.get('stream_responses', 0)))
+        self.writer_queue_size = int(advanced_params.get('writer_queue_size', WRITER_QUEUE_SIZE))
+        self.output_buffer_size = int(advanced_params.get('output_buffer_size', OUTPUT_BUFFER_SIZE))
         self.reference_date = advanced_params.get('reference_date')
+        self.api_url = advanced_params.get('api_url')
+        self.profile = bool(int(advanced_params.get('profile', 0)))
         self.full_analysis_output = bool(int(advanced_params.get('full_analysis_output', 0)))
+        self.output_format = advanced_params.get('output_format', 'csv')
+        self.full_output_codec = advanced_params.get('full_output_codec', CODEC_PICKLE_BZ2)
+        self.full_output_dictionary = advanced_params.get('full_output_dictionary')
+        self.max_retries = int(advanced_params.get('max_retries', MAX_RETRIES))
+        self.retry_backoff = float(advanced_params.get('retry_backoff', RETRY_BACKOFF))
+        self.retry_max_backoff = float(advanced_params.get('retry_max_backoff', RETRY_MAX_BACKOFF))
+        self.retry_after_limit = float(advanced_params.get('retry_after_limit', RETRY_AFTER_LIMIT))
+        self.adaptive_concurrency = bool(int(advanced_params.get('adaptive_concurrency', 1)))
+        self.dead_letter = bool(int(advanced_params.get('dead_letter', 1)))
+        self.replay_dead_letter = bool(int(advanced_params.get('replay_dead_letter', 0)))
+        self.checkpoint = bool(int(advanced_params.get('checkpoint', 0)))
+        self.checkpoint_interval = int(advanced_params.get('checkpoint_interval', CHECKPOINT_INTERVAL))
+        self.incremental = bool(int(advanced_params.get('incremental', 0)))
+        self.incremental_index_path = advanced_params.get('incremental_index_path', INCREMENTAL_INDEX_PATH)
+        self.dedup = bool(int(advanced_params.get('dedup', 0)))
+        self.dedup_memory_entries = int(advanced_params.get('dedup_memory_entries', DEDUP_MEMORY_ENTRIES))
+        self.cache_path = advanced_params.get('cache_path')
+        self.cache_max_entries = int(advanced_params.get('cache_max_entries', CACHE_MAX_ENTRIES))
+        self.cache_ttl_days = float(advanced_params.get('cache_ttl_days', CACHE_TTL_DAYS))
+        self.dry_run = bool(int(advanced_params.get('dry_run', 0)))
+        self.dry_run_latency = advanced_params.get('dry_run_latency')
+        if self.dry_run_latency is not None:
+            self.dry_run_latency = float(self.dry_run_latency)
+
+        self.tables = params.get('tables', [])
+        self.output_prefix = ''
+        self.table_params = []
 
         self.validate()
+        if self.tables:
+            self.table_params = self.get_table_params()
 
     def get_customer_id(self):
         stack_id = os.getenv('KBC_STACKID')
@@ -114,12 +364,87 @@ class Params:
             raise ValueError('the "KBC_PROJECTID" environment variable needs to be set')
         if self.user_key is None:
             raise ValueError('the "user_key" parameter has to be provided')
+        if self.tables:
+            self.validate_tables()
+        else:
+            self.validate_columns()
+        if self.analysis_types and len(self.analysis_types - ANALYSIS_TYPES) > 0:
+            raise ValueError('invalid "analysisTypes" parameter, allowed values are {types}'.format(types=ANALYSIS_TYPES))
+        if self.api_url is not None and not (isinstance(self.api_url, str) and self.api_url.startswith('http')):
+            raise ValueError('the "api_url" parameter needs to be an HTTP URL')
+        if self.thread_count > 32:
+            raise ValueError('the "thread_count" parameter can not be greater than 32')
+        if self.batching not in BATCHING_MODES:
+            raise ValueError('invalid "batching" parameter, allowed values are {modes}'.format(modes=BATCHING_MODES))
+        if self.doc_batch_size < 1:
+            raise ValueError('the "doc_batch_size" parameter needs to be positive')
+        if not 0 < self.max_batch_bytes <= MAX_REQ_SIZE:
+            raise ValueError('the "max_batch_bytes" parameter needs to be between 1 and {max}'.format(max=MAX_REQ_SIZE))
+        if self.reader_processes < 1 or self.reader_shard_size < 1:
+            raise ValueError('the "reader_processes" and "reader_shard_size" parameters need to be positive')
+        if self.mapped_input and self.reader_processes > 1:
+            raise ValueError('the "mapped_input" parameter can not be combined with the "reader_processes" parameter')
+        if self.writer_queue_size < 1 or self.output_buffer_size < 1:
+            raise ValueError('the "writer_queue_size" and "output_buffer_size" parameters need to be positive')
+        if self.engine not in ENGINES:
+            raise ValueError('invalid "engine" parameter, allowed values are {engines}'.format(engines=ENGINES))
+        if self.async_max_in_flight < 1 or self.async_connection_limit < 1:
+            raise ValueError('the "async_max_in_flight" and "async_connection_limit" parameters need to be positive')
+        if not isinstance(self.language_detection, list) or not set(self.language_detection) <= LANGUAGES:
+            raise ValueError('invalid "language_detection" parameter, it needs to be an array of languages '
+                             'from {langs}'.format(langs=sorted(LANGUAGES)))
+        if self.language_detection and (self.language or self.checkpoint):
+            raise ValueError('the "language_detection" parameter can not be combined with '
+                             'the "language" or "checkpoint" parameters')
+        if self.oversized_docs not in OVERSIZED_DOCS_MODES:
+            raise ValueError('invalid "oversized_docs" parameter, allowed values are {modes}'.format(
+                modes=OVERSIZED_DOCS_MODES))
+        if self.oversized_docs == 'chunk' and self.checkpoint:
+            raise ValueError('the "oversized_docs" parameter can not be "chunk" with the "checkpoint" parameter')
+        if self.max_memory_mb < 0:
+            raise ValueError('the "max_memory_mb" parameter can not be negative')
+        if self.lookahead < 0 or self.reorder_buffer < 0:
+            raise ValueError('the "lookahead" and "reorder_buffer" parameters can not be negative')
+        if self.output_format not in OUTPUT_FORMATS:
+            raise ValueError('invalid "output_format" parameter, allowed values are {formats}'.format(
+                formats=OUTPUT_FORMATS))
+        if self.output_format != 'csv' and self.checkpoint:
+            raise ValueError('the "checkpoint" parameter can be used only with the "csv" output format')
+        if self.full_output_codec not in CODECS:
+            raise ValueError('invalid "full_output_codec" parameter, allowed values are {codecs}'.format(codecs=CODECS))
+        if self.full_output_dictionary and self.full_output_codec == CODEC_PICKLE_BZ2:
+            raise ValueError('the "full_output_dictionary" parameter can not be used with the "{codec}" codec'.format(
+                codec=CODEC_PICKLE_BZ2))
+        if (self.max_retries < 0 or self.retry_backoff < 0 or self.retry_max_backoff < 0
+                or self.retry_after_limit < 0):
+            raise ValueError('the "max_retries", "retry_backoff", "retry_max_backoff" and "retry_after_limit" parameters '
+                             'can not be negative')
+        if self.checkpoint and not self.ordered_output:
+            raise ValueError('the "checkpoint" parameter requires the "ordered_output"')
+        if self.checkpoint_interval < 1:
+            raise ValueError('the "checkpoint_interval" parameter needs to be positive')
+        if self.incremental and (self.checkpoint or self.reader_processes > 1 or self.replay_dead_letter):
+            raise ValueError('the "incremental" parameter can not be combined with '
+                             'the "checkpoint", "reader_processes" or "replay_dead_letter" parameters')
+        if self.incremental and not isinstance(self.incremental_index_path, str):
+            raise ValueError('the "incremental_index_path" parameter needs to be a file path')
+        if self.dry_run and (self.checkpoint or self.incremental or self.replay_dead_letter):
+            raise ValueError('the "dry_run" parameter can not be combined with '
+                             'the "checkpoint", "incremental" or "replay_dead_letter" parameters')
+        if self.dry_run_latency is not None and self.dry_run_latency <= 0:
+            raise ValueError('the "dry_run_latency" parameter needs to be positive')
+        if self.dedup_memory_entries < 1:
+            raise ValueError('the "dedup_memory_entries" parameter needs to be positive')
+        if self.cache_path is not None and not isinstance(self.cache_path, str):
+            raise ValueError('the "cache_path" parameter needs to be a file path')
+        if self.cache_max_entries < 0 or self.cache_ttl_days < 0:
+            raise ValueError('the "cache_max_entries" and "cache_ttl_days" parameters can not be negative')
+
+    def validate_columns(self):
         if self.source_tab_path is None:
-            raise ValueError('exactly one INPUT table mapping needs to be specified')
+            raise ValueError('exactly one INPUT table mapping needs to be specified, or the "tables" parameter')
         if not self.id_cols or not self.text_cols:
             raise ValueError('the "columns.id" and "columns.text" are required parameters')
-        if self.analysis_types and len(self.analysis_types - ANALYSIS_TYPES) > 0:
-            raise ValueError('invalid "analysisTypes" parameter, allowed values are {types}'.format(types=ANALYSIS_TYPES))
         for cols in (self.id_cols, self.text_cols, self.title_cols, self.lead_cols):
             if not isinstance(cols, list):
                 raise ValueError('invalid "column" parameter, all values need to be an array of column names')
@@ -128,122 +453,818 @@ class Params:
                           'usedChars', 'index', 'text', 'type', 'score', 'entityUid', 'name', 'negated', 'subject', 'object',
                           'subjectType', 'objectType', 'subjectUid', 'objectUid', 'segment', 'binaryData'):
                 raise ValueError('invalid "column.id" parameter, value "{col}" is a reserved name'.format(col=id_col))
-        if self.thread_count > 32:
-            raise ValueError('the "thread_count" parameter can not be greater than 32')
+
+    def validate_tables(self):
+        if not isinstance(self.tables, list) or not all(isinstance(table, dict) for table in self.tables):
+            raise ValueError('invalid "tables" parameter, it needs to be an array of objects')
+        sources = set(in_tab['destination'] for in_tab in self.config.get_input_tables())
+        for table in self.tables:
+            if table.get('source') not in sources:
+                raise ValueError('the "source" of each of the "tables" needs to be the destination '
+                                 'of an INPUT table mapping, one of {sources}'.format(sources=sorted(sources)))
+        prefixes = [self.get_table_prefix(table) for table in self.tables]
+        if len(set(prefixes)) < len(prefixes):
+            raise ValueError('the "output_prefix" of each of the "tables" needs to be unique')
+
+    @staticmethod
+    def get_table_prefix(table):
+        return table.get('output_prefix', os.path.splitext(table['source'])[0] + '-')
+
+    def get_table_params(self):
+        in_tabs = {in_tab['destination']: in_tab['full_path'] for in_tab in self.config.get_input_tables()}
+        table_params = []
+        for table in self.tables:
+            # the parameters missing in the table are inherited from the component configuration
+            params = copy.copy(self)
+            columns = table.get('columns', {})
+            if not isinstance(columns, dict):
+                columns = {}
+            params.tables = []
+            params.source_tab_path = in_tabs[table['source']]
+            params.output_prefix = self.get_table_prefix(table)
+            params.id_cols = columns.get('id', self.id_cols)
+            params.text_cols = columns.get('text', self.text_cols)
+            params.title_cols = columns.get('title', self.title_cols)
+            params.lead_cols = columns.get('lead', self.lead_cols)
+            params.language = table.get('language', self.language)
+            params.domain = table.get('domain', self.domain)
+            params.validate()
+            table_params.append(params)
+        return table_params
+
+    def get_api_url(self):
+        if self.api_url:
+            return self.api_url
+        return BASE_URL if not self.use_beta else BETA_URL
 
     def get_output_path(self, filename):
         return os.path.normpath(os.path.join(
-                self.config.get_data_dir(), 'out', 'tables', filename
+                self.config.get_data_dir(), 'out', 'tables', self.output_prefix + filename
+        ))
+
+    def get_data_path(self, path):
+        # the state files of the tables analyzed in one run are told apart by the prefix of their output tables
+        head, filename = os.path.split(path)
+        return os.path.normpath(os.path.join(
+                self.config.get_data_dir(), head, self.output_prefix + filename
         ))
 
+    def get_output_table_path(self, filename):
+        if self.output_format != 'csv':
+            filename = os.path.splitext(filename)[0] + '.' + self.output_format
+        return self.get_output_path(filename)
+
     def get_usage_path(self):
         return os.path.normpath(os.path.join(
                 self.config.get_data_dir(), 'out', 'usage.json'
         ))
 
+    def get_metrics_path(self):
+        return os.path.normpath(os.path.join(
+                self.config.get_data_dir(), 'out', 'metrics.json'
+        ))
+
+    def get_estimate_path(self):
+        return self.get_data_path(os.path.join('out', 'estimate.json'))
+
+    def get_profile_path(self):
+        return os.path.normpath(os.path.join(
+                self.config.get_data_dir(), 'out', 'profile.pstats'
+        ))
+
+    def get_dead_letter_path(self):
+        return self.get_data_path('dead-letter.jsonl')
+
+    def get_dead_letter_replay_path(self):
+        return self.get_data_path('dead-letter-replay.jsonl')
+
+    def get_checkpoint_path(self):
+        return self.get_data_path('checkpoint.json')
+
+    def get_full_output_dictionary(self):
+        if not self.full_output_dictionary:
+            return None
+        dictionary_path = os.path.normpath(os.path.join(
+                self.config.get_data_dir(), self.full_output_dictionary
+        ))
+        with open(dictionary_path, 'rb') as dictionary_file:
+            return dictionary_file.read()
+
+    def get_incremental_index_path(self):
+        return self.get_data_path(self.incremental_index_path)
+
+    def get_cache_path(self):
+        if not self.cache_path:
+            return None
+        return self.get_data_path(self.cache_path)
+
     @staticmethod
     def init(data_dir=''):
+        from keboola import docker
+
         return Params(docker.Config(data_dir))
 
 class AnalysisApp:
 
-    def __init__(self, *, data_dir=''):
-        self.params = Params.init(data_dir)
-        self.validate_input()
+    def __init__(self, *, data_dir='', params=None, shared=None):
+        self.params = params or Params.init(data_dir)
+        # the app running all the tables, its request executor and limits are shared by the apps of the tables
+        self.shared = shared
+        self.executor = None
+        self.table_apps = []
+        self.report_lock = threading.Lock()
+        self.usage_counts = (0, 0)
+        self.cache = None
+        self.dedup = None
+        self.dedup_waiters = defaultdict(list)
+        self.fingerprints = None
+        self.pending_fingerprints = {}
+        self.writers = {}
+        self.direct_output = False
+        self.unbilled_chars = 0
+        self.metrics = shared.metrics if shared is not None else Metrics()
+        self.language_detector = None
+        if self.params.language_detection:
+            self.language_detector = LanguageDetector(self.params.language_detection)
+        self.empty_count = 0
+        self.pending_empty_count = 0
+        self.truncated_count = 0
+        self.chunked_count = 0
+        self.chunk_docs = {}
+        self.chunk_parts = defaultdict(dict)
+        # the chunked documents until all their chunks are analyzed, a document with a failed chunk is written
+        # to the dead letter whole, so that its replay chunks it again
+        self.chunked_originals = {}
+        self.failed_chunked_count = 0
+        self.batcher = DocBatcher(max_size=self.params.max_batch_bytes, max_docs=self.params.max_batch_docs,
+                                  adaptive=self.params.adaptive_batching)
+        if shared is not None:
+            self.memory_budget = shared.memory_budget
+            self.retry = shared.retry
+            self.limiter = shared.limiter
+        else:
+            self.memory_budget = None
+            if self.params.max_memory_mb:
+                self.memory_budget = MemoryBudget(int(self.params.max_memory_mb * 2 ** 20))
+            self.retry = RetryPolicy(max_retries=self.params.max_retries, backoff=self.params.retry_backoff,
+                                     max_backoff=self.params.retry_max_backoff,
+                                     retry_after_limit=self.params.retry_after_limit)
+            self.limiter = None
+            if self.params.adaptive_concurrency:
+                max_concurrency = self.params.async_max_in_flight if self.params.engine == 'async' else self.params.thread_count
+                self.limiter = ConcurrencyLimiter(max_concurrency)
+        self.serialize = make_serializer(self.params.full_output_codec, self.params.get_full_output_dictionary())
+        self.dead_letter = None
+        if self.params.dead_letter and not self.params.tables:
+            self.dead_letter = DeadLetterWriter(self.params.get_dead_letter_path())
+        self.deferred_dead_letter = None
+        if self.dead_letter is not None and self.params.checkpoint:
+            self.deferred_dead_letter = DeferredDeadLetter(self.dead_letter)
 
-    def validate_input(self):
-        with open(self.params.source_tab_path, 'r', encoding='utf-8') as in_tab:
-            try:
-                row = next(read_csv(in_tab))
-            except StopIteration:
-                print('WARN: could not read any data from the source table')
-                sys.stdout.flush()
-                return
-            all_cols = self.params.id_cols + self.params.text_cols + self.params.title_cols + self.params.lead_cols
-            for col in all_cols:
-                if col not in row:
-                    raise ValueError('the source table does not contain column "{col}"'.format(col=col))
+    def validate_input(self, fieldnames):
+        if not fieldnames:
+            print('WARN: could not read any data from the source table')
+            sys.stdout.flush()
+            return
+        all_cols = self.params.id_cols + self.params.text_cols + self.params.title_cols + self.params.lead_cols
+        for col in all_cols:
+            if col not in fieldnames:
+                raise ValueError('the source table does not contain column "{col}"'.format(col=col))
 
     def run(self):
-        print('starting NLP analysis with features {types}'.format(types=self.params.analysis_types))
+        if not self.params.profile:
+            return self.run_analysis()
+
+        import cProfile
+        profiler = cProfile.Profile()
+        try:
+            return profiler.runcall(self.run_analysis)
+        finally:
+            profiler.dump_stats(self.params.get_profile_path())
+
+    def run_analysis(self):
+        if self.params.tables:
+            return self.run_tables()
+        if self.params.dry_run:
+            return self.run_estimate()
+
+        print('starting NLP analysis{of} with features {types}'.format(
+            of=self.get_table_label(), types=self.params.analysis_types))
         sys.stdout.flush()
         doc_count = 0
         used_chars = 0
+        input_rows = 0
 
-        out_tab_doc_path = self.params.get_output_path(OUT_TAB_DOC)
-        out_tab_snt_path = self.params.get_output_path(OUT_TAB_SNT)
-        out_tab_ent_path = self.params.get_output_path(OUT_TAB_ENT)
-        out_tab_rel_path = self.params.get_output_path(OUT_TAB_REL)
-        out_tab_full_path = self.params.get_output_path(OUT_TAB_FULL)
+        cache_path = self.params.get_cache_path()
+        if cache_path:
+            self.cache = ResultCache(cache_path, max_entries=self.params.cache_max_entries,
+                                     ttl_days=self.params.cache_ttl_days)
+
+        if self.params.dedup:
+            self.dedup = DedupIndex(memory_entries=self.params.dedup_memory_entries)
+        if self.params.incremental:
+            self.fingerprints = FingerprintIndex(self.params.get_incremental_index_path())
+
+        checkpoint = self.load_checkpoint() if self.params.checkpoint else None
+        out_sizes = checkpoint['outputs'] if checkpoint else {}
+        if checkpoint:
+            input_rows = checkpoint['input_rows']
+            if self.dead_letter is not None and checkpoint.get('dead_letter') is not None:
+                self.dead_letter.truncate(checkpoint['dead_letter'])
+            print('resuming the analysis after {n} input rows'.format(n=input_rows))
+            sys.stdout.flush()
+        checkpoint_rows = input_rows
+
+        output_plan = self.get_output_plan()
         with open(self.params.source_tab_path, 'r', encoding='utf-8') as in_tab, \
-             open(out_tab_doc_path, 'w', encoding='utf-8') as out_tab_doc, \
-             open(out_tab_snt_path, 'w', encoding='utf-8') as out_tab_snt, \
-             open(out_tab_ent_path, 'w', encoding='utf-8') as out_tab_ent, \
-             open(out_tab_rel_path, 'w', encoding='utf-8') as out_tab_rel, \
-             open(out_tab_full_path, 'w', encoding='utf-8') as out_tab_full:
-            doc_writer = csv_writer(out_tab_doc, fields=self.get_doc_tab_fields())
-            snt_writer = csv_writer(out_tab_snt, fields=self.get_snt_tab_fields())
-            ent_writer = csv_writer(out_tab_ent, fields=self.get_ent_tab_fields())
-            rel_writer = csv_writer(out_tab_rel, fields=self.get_rel_tab_fields())
-            full_writer = csv_writer(out_tab_full, fields=self.get_full_tab_fields())
-
-            for doc_analysis in self.analyze(read_csv(in_tab)):
-                doc_writer.writerows(self.analysis_to_doc_result(doc_analysis))
-                snt_writer.writerows(self.analysis_to_snt_result(doc_analysis))
-                ent_writer.writerows(self.analysis_to_ent_result(doc_analysis))
-                rel_writer.writerows(self.analysis_to_rel_result(doc_analysis))
-                full_writer.writerows(self.analysis_to_full_result(doc_analysis))
-
-                doc_count += 1
-                used_chars += int(doc_analysis['usedChars'])
-                if doc_count % 1000 == 0:
-                    self.write_usage(doc_count=doc_count, used_chars=used_chars)
-                    print('successfully analyzed {n} documents with {ch} characters'.format(n=doc_count, ch=used_chars))
-                    sys.stdout.flush()
+             contextlib.ExitStack() as out_tabs:
+            # the header is read only once, it is validated and then given to the reader of the rows
+            fieldnames = read_csv_fieldnames(in_tab)
+            self.validate_input(fieldnames)
+            writers = {}
+            for table in output_plan:
+                fields = getattr(self, table.fields)()
+                out_tab, row_writer = None, None
+                if self.params.output_format == 'parquet':
+                    row_writer = self.make_parquet_writer(table, fields)
+                else:
+                    out_tab = out_tabs.enter_context(open_output(
+                        self.params.get_output_path(table.filename),
+                        resume_size=out_sizes.get(table.filename), buffer_size=self.params.output_buffer_size
+                    ))
+                writers[table.filename] = TableWriter(
+                    out_tab, fields=fields, flatten=getattr(self, table.flatten),
+                    header=checkpoint is None, queue_size=self.params.writer_queue_size,
+                    name=self.params.output_prefix + table.filename, metrics=self.metrics, row_writer=row_writer
+                )
+
+            self.writers = writers
+            self.direct_output = self.writes_directly()
+            timed_stream = self.metrics.timed_stream
+            if self.params.replay_dead_letter:
+                doc_stream = itertools.islice(timed_stream('read', self.replay_doc_stream()), input_rows, None)
+                batch_stream = self.analyze_doc_batches(doc_stream)
+            elif self.fingerprints is not None:
+                batch_stream = self.analyze_doc_batches(timed_stream('read', self.incremental_doc_stream(in_tab, fieldnames)))
+            elif self.params.reader_processes > 1:
+                doc_stream = itertools.islice(timed_stream('read', self.sharded_doc_stream()), input_rows, None)
+                batch_stream = self.analyze_doc_batches(doc_stream)
+            elif self.params.mapped_input:
+                doc_stream = itertools.islice(timed_stream('read', self.mapped_doc_stream()), input_rows, None)
+                batch_stream = self.analyze_doc_batches(doc_stream)
+            else:
+                row_stream = itertools.islice(timed_stream('read', read_csv(in_tab, fieldnames)), input_rows, None)
+                batch_stream = self.analyze_batches(row_stream)
+
+            try:
+                for row_count, batch_analysis, memory in batch_stream:
+                    # the writers flatten the analyses in their own threads, the document IDs are parsed only once;
+                    # the analyses written directly by the request threads are only counted here
+                    items = [] if self.direct_output else [
+                        (doc_analysis, self.get_doc_id_values(doc_analysis)) for doc_analysis in batch_analysis
+                    ]
+                    done = None
+                    if self.memory_budget is not None:
+                        done = self.memory_budget.release_after(memory, len(writers))
+                    with self.metrics.timer('output_queue_wait'):
+                        for writer in writers.values():
+                            writer.write(items, done)
+                    if self.fingerprints is not None:
+                        self.store_fingerprints(batch_analysis)
+
+                    batch_start_count = doc_count
+                    doc_count += len(batch_analysis)
+                    used_chars += sum(int(doc_analysis['usedChars']) for doc_analysis in batch_analysis)
+                    input_rows += row_count
+                    if doc_count // 1000 > batch_start_count // 1000:
+                        if self.cache is not None:
+                            self.cache.commit()
+                        self.write_usage(doc_count=doc_count, used_chars=used_chars - self.unbilled_chars)
+                        self.write_metrics()
+                        print('successfully analyzed {n} documents with {ch} characters{mem}'.format(
+                            n=doc_count, ch=used_chars - self.unbilled_chars, mem=self.format_memory_usage()))
+                        sys.stdout.flush()
+
+                    if self.params.checkpoint and input_rows - checkpoint_rows >= self.params.checkpoint_interval:
+                        if self.cache is not None:
+                            self.cache.commit()
+                        for writer in writers.values():
+                            writer.join()
+                        self.write_checkpoint(input_rows=input_rows, out_tabs={
+                            filename: writer.output_file for filename, writer in writers.items()
+                        })
+                        checkpoint_rows = input_rows
+            finally:
+                # all writers are closed even when one of them fails, the first error is raised after
+                close_error = None
+                for writer in writers.values():
+                    try:
+                        writer.close()
+                    except Exception as e:
+                        close_error = close_error or e
+                if close_error is not None:
+                    raise close_error
 
+        if self.cache is not None:
+            self.cache.close()
+            print('result cache: {h} hits, {m} misses'.format(h=self.cache.hits, m=self.cache.misses))
+        if self.fingerprints is not None:
+            # the fingerprints are stored only after the whole job succeeded
+            self.fingerprints.commit()
+            self.fingerprints.close()
+            print('incremental analysis: {s} unchanged documents were skipped, {u} documents were analyzed'.format(
+                s=self.fingerprints.skipped, u=self.fingerprints.updated))
+        if self.empty_count:
+            print('{n} documents without any text were skipped'.format(n=self.empty_count))
+        if self.truncated_count or self.chunked_count:
+            print('{t} too large documents were truncated, {c} were split into chunks'.format(
+                t=self.truncated_count, c=self.chunked_count))
+        if self.failed_chunked_count:
+            print('WARN: {n} chunked documents were not written, some of their chunks failed'.format(
+                n=self.failed_chunked_count))
+        if self.dedup is not None:
+            self.dedup.close()
+            print('deduplication: {n} duplicate documents with {ch} characters were not sent for analysis'.format(
+                n=self.dedup.dup_count, ch=self.dedup.saved_chars))
+        if self.retry.retry_count or (self.limiter is not None and self.limiter.throttle_count):
+            print('{r} requests were retried, the API throttled {t} requests'.format(
+                r=self.retry.retry_count, t=self.limiter.throttle_count if self.limiter is not None else 0))
+        if self.dead_letter is not None:
+            self.dead_letter.close()
+            if self.dead_letter.doc_count:
+                print('{n} failed documents were written to "{path}", use the "replay_dead_letter" parameter to retry them'.format(
+                    n=self.dead_letter.doc_count, path=self.dead_letter.path))
+        used_chars -= self.unbilled_chars
         self.write_usage(doc_count=doc_count, used_chars=used_chars)
-        self.write_manifest(doc_tab_path=out_tab_doc_path, snt_tab_path=out_tab_snt_path,
-                            ent_tab_path=out_tab_ent_path, rel_tab_path=out_tab_rel_path,
-                            full_tab_path=out_tab_full_path)
-
-        if self.params.analysis_types and not 'sentiment' in self.params.analysis_types:
-            os.unlink(out_tab_snt_path)
-            os.unlink(out_tab_snt_path + '.manifest')
-        if self.params.analysis_types and not {'entities', 'tags'} & self.params.analysis_types:
-            os.unlink(out_tab_ent_path)
-            os.unlink(out_tab_ent_path + '.manifest')
-        if self.params.analysis_types and not 'relations' in self.params.analysis_types:
-            os.unlink(out_tab_rel_path)
-            os.unlink(out_tab_rel_path + '.manifest')
-        if not self.params.full_analysis_output:
-            os.unlink(out_tab_full_path)
-            os.unlink(out_tab_full_path + '.manifest')
-
-        print('the analysis has finished successfully, {n} documents with {ch} characters were analyzed'.format(n=doc_count, ch=used_chars))
+        self.write_metrics()
+        print('sent {n} requests with an average batch fill of {fill:.1%} of {max} bytes'.format(
+            n=self.batcher.batch_count, fill=self.batcher.avg_fill(), max=self.params.max_batch_bytes))
+        for table in output_plan:
+            self.write_manifest(table, self.params.get_output_table_path(table.filename))
+        if self.params.checkpoint and os.path.exists(self.params.get_checkpoint_path()):
+            os.unlink(self.params.get_checkpoint_path())
+        if self.params.replay_dead_letter and os.path.exists(self.params.get_dead_letter_replay_path()):
+            os.unlink(self.params.get_dead_letter_replay_path())
+
+        print('the analysis{of} has finished successfully, {n} documents with {ch} characters were analyzed'.format(
+            of=self.get_table_label(), n=doc_count, ch=used_chars))
+        sys.stdout.flush()
+
+    def run_tables(self):
+        from concurrent.futures import ThreadPoolExecutor
+
+        print('starting NLP analysis of {n} tables'.format(n=len(self.params.table_params)))
+        sys.stdout.flush()
+        with self.request_executor() as self.executor:
+            self.table_apps = [AnalysisApp(params=params, shared=self) for params in self.params.table_params]
+            with ThreadPoolExecutor(max_workers=len(self.table_apps), thread_name_prefix='table') as runner:
+                runs = [runner.submit(table_app.run_analysis) for table_app in self.table_apps]
+                for run in runs:
+                    run.result()
+
+        if self.params.dry_run:
+            print('the dry run of all tables has finished, no requests were sent to the API')
+            sys.stdout.flush()
+            return
+        self.write_tables_usage()
+        self.write_metrics()
+        doc_count = sum(table_app.usage_counts[0] for table_app in self.table_apps)
+        used_chars = sum(table_app.usage_counts[1] for table_app in self.table_apps)
+        print('the analysis of all tables has finished successfully, {n} documents with {ch} characters were '
+              'analyzed'.format(n=doc_count, ch=used_chars))
+        sys.stdout.flush()
+
+    def run_estimate(self):
+        print('starting a dry run{of}, no requests are sent to the API'.format(of=self.get_table_label()))
         sys.stdout.flush()
+        start = time.perf_counter()
+        estimate = CostEstimate()
+        # the duplicates are found the same way as with the "dedup" parameter, they are sent only without it
+        dups = DedupIndex(memory_entries=self.params.dedup_memory_entries)
+        try:
+            with open(self.params.source_tab_path, 'r', encoding='utf-8') as in_tab:
+                fieldnames = read_csv_fieldnames(in_tab)
+                self.validate_input(fieldnames)
+                if self.params.reader_processes > 1:
+                    doc_stream = self.sharded_doc_stream()
+                elif self.params.mapped_input:
+                    doc_stream = self.mapped_doc_stream()
+                else:
+                    doc_stream = map(self.row_to_doc, read_csv(in_tab, fieldnames))
+
+                if self.params.skip_empty_texts:
+                    doc_stream = self.skip_empty_docs(doc_stream)
+                doc_stream = estimate.count_docs(doc_stream)
+                if self.params.oversized_docs != 'skip':
+                    doc_stream = self.fit_doc_stream(doc_stream)
+                for _, docs in self.doc_batch_stream(doc_stream):
+                    # the chunks are never merged, only their count matters
+                    self.chunk_docs.clear()
+                    self.chunked_originals.clear()
+                    sent = []
+                    for doc in docs:
+                        if dups.add(DedupIndex.make_key(doc)):
+                            sent.append(doc)
+                            continue
+                        estimate.add_duplicate(doc)
+                        if not self.params.dedup:
+                            sent.append(doc)
+                    estimate.add_batch(docs, sent)
+        finally:
+            dups.close()
+
+        input_seconds = time.perf_counter() - start
+        thread_counts = sorted(set(PROJECTED_THREAD_COUNTS) | {self.params.thread_count})
+        snapshot = estimate.snapshot(latency=self.params.dry_run_latency, thread_counts=thread_counts,
+                                     input_seconds=input_seconds)
+        snapshot['empty_documents'] = self.empty_count
+        snapshot['truncated_documents'] = self.truncated_count
+        snapshot['chunked_documents'] = self.chunked_count
+        write_json_atomic(self.params.get_estimate_path(), snapshot)
+
+        print('{n} documents with {ch} characters, {e} documents without any text would be skipped'.format(
+            n=estimate.doc_count, ch=estimate.input_chars, e=self.empty_count))
+        print('{r} requests with an estimated {ch} characters would be sent, {s} too large documents would be '
+              'skipped'.format(r=estimate.request_count, ch=estimate.chars, s=estimate.skipped_count))
+        if self.truncated_count or self.chunked_count:
+            print('{t} too large documents would be truncated, {c} would be split into chunks'.format(
+                t=self.truncated_count, c=self.chunked_count))
+        print('{n} duplicate documents with {ch} characters, {ratio:.1%} of the documents, would be {verb}'.format(
+            n=estimate.dup_count, ch=estimate.dup_chars, ratio=estimate.dup_ratio(),
+            verb='analyzed only once' if self.params.dedup else 'analyzed again, see the "dedup" parameter'))
+        if self.params.dry_run_latency is None:
+            print('set the "dry_run_latency" parameter to project the wall time of the analysis')
+        else:
+            for thread_count in thread_counts:
+                print('projected wall time with {t} client threads: {secs:.1f} s'.format(
+                    t=thread_count, secs=estimate.project_wall_time(self.params.dry_run_latency, thread_count,
+                                                                    input_seconds)))
+        print('the dry run{of} has finished, the estimate was written to "{path}"'.format(
+            of=self.get_table_label(), path=self.params.get_estimate_path()))
+        sys.stdout.flush()
+
+    def writes_directly(self):
+        # the streamed analyses are handed to the writers as soon as they are decoded only when nothing is done
+        # with them per batch: no ordering, checkpoints, cache, deduplication, fingerprints or merging of chunks
+        return (self.params.stream_responses and not self.params.ordered_output and not self.params.checkpoint
+                and self.cache is None and self.dedup is None and self.fingerprints is None
+                and self.params.oversized_docs != 'chunk')
+
+    def write_analysis(self, doc_analysis):
+        # called by the request threads, a full writer queue holds the decoding back
+        items = [(doc_analysis, self.get_doc_id_values(doc_analysis))]
+        for writer in self.writers.values():
+            writer.write(items)
+
+    def get_table_label(self):
+        if self.shared is None:
+            return ''
+        return ' of the table "{tab}"'.format(tab=os.path.basename(self.params.source_tab_path))
+
+    def make_parquet_writer(self, table, fields):
+        from parquet_output import ParquetRowWriter
+
+        return ParquetRowWriter(self.params.get_output_table_path(table.filename), fields=fields, types=COLUMN_TYPES)
+
+    def get_output_plan(self):
+        return [table for table in OUTPUT_TABLES if table.enabled(self.params)]
+
+    def load_checkpoint(self):
+        checkpoint_path = self.params.get_checkpoint_path()
+        if not os.path.exists(checkpoint_path):
+            return None
+        with open(checkpoint_path, 'r', encoding='utf-8') as checkpoint_file:
+            checkpoint = json.load(checkpoint_file)
+        if checkpoint.get('fingerprint') != self.get_checkpoint_fingerprint():
+            print('WARN: ignoring the checkpoint of an analysis with a different configuration')
+            sys.stdout.flush()
+            return None
+        for filename, size in checkpoint['outputs'].items():
+            out_path = self.params.get_output_path(filename)
+            if not os.path.exists(out_path) or os.path.getsize(out_path) < size:
+                raise ValueError('the output table "{tab}" does not match the checkpoint'.format(tab=filename))
+        return checkpoint
+
+    def write_checkpoint(self, *, input_rows, out_tabs):
+        write_json_atomic(self.params.get_checkpoint_path(), {
+            'fingerprint': self.get_checkpoint_fingerprint(),
+            'input_rows': input_rows,
+            'outputs': {filename: flushed_size(out_tab) for filename, out_tab in out_tabs.items()},
+            'dead_letter': self.dead_letter.size() if self.dead_letter is not None else None
+        })
+
+    def get_checkpoint_fingerprint(self):
+        req = self.get_request()
+        req.pop('customerId', None)
+        columns = [self.params.id_cols, self.params.text_cols, self.params.title_cols, self.params.lead_cols]
+        source = 'dead-letter' if self.params.replay_dead_letter else os.path.basename(self.params.source_tab_path)
+        fingerprint = json.dumps([source, columns, req], sort_keys=True)
+        return hashlib.sha256(fingerprint.encode('utf-8')).hexdigest()
 
     def analyze(self, row_stream):
-        url = BASE_URL if not self.params.use_beta else BETA_URL
+        for _, batch_analysis, memory in self.analyze_batches(row_stream):
+            if self.memory_budget is not None:
+                self.memory_budget.release(memory)
+            yield from batch_analysis
+
+    def analyze_batches(self, row_stream):
+        return self.analyze_doc_batches(map(self.metrics.timed('row_to_doc', self.row_to_doc), row_stream))
+
+    def analyze_doc_batches(self, doc_stream):
+        url = self.params.get_api_url()
         user_key = self.params.user_key
         req = self.get_request()
 
-        batch_stream = self.doc_batch_stream(row_stream)
+        if self.params.skip_empty_texts:
+            doc_stream = self.skip_empty_docs(doc_stream)
+        if self.params.oversized_docs != 'skip':
+            doc_stream = self.fit_doc_stream(doc_stream)
+        batch_stream = (self.make_doc_batch(docs, language) for language, docs in self.doc_batch_stream(doc_stream))
+        if self.cache is not None:
+            batch_stream = self.cache_lookup_stream(batch_stream, req)
+        if self.dedup is not None:
+            batch_stream = self.dedup_lookup_stream(batch_stream)
+
+        for batch, batch_analysis, latency in self.result_stream(batch_stream, req, url=url, user_key=user_key):
+            if self.deferred_dead_letter is not None:
+                self.deferred_dead_letter.flush(batch.docs)
+            if batch.docs:
+                # only the requests really sent are observed, a too large batch is split into several requests
+                # and a too large document is not sent at all; each gets its part of the latency by its size
+                requests, _ = plan_batch_requests(batch.docs)
+                sizes = [batch_request_size(docs) for docs in requests]
+                for docs, size in zip(requests, sizes):
+                    self.batcher.observe(size, latency * size / sum(sizes))
+                    self.metrics.observe_batch(len(docs), size)
+            for doc_analysis in batch.hits:
+                self.unbilled_chars += int(doc_analysis['usedChars'])
+            if self.cache is not None:
+                self.cache_results(batch, batch_analysis)
+            if self.dedup is not None:
+                batch_analysis = batch_analysis + self.dedup_results(batch, batch_analysis)
+            batch_analysis = batch.hits + batch_analysis
+            if self.params.oversized_docs == 'chunk':
+                batch_analysis = self.merge_chunks(batch, batch_analysis)
+            yield batch.row_count, batch_analysis, batch.memory
+
+    def make_doc_batch(self, docs, language=None):
+        memory = 0
+        if self.memory_budget is not None:
+            memory = batch_request_size(docs) * MEMORY_PER_REQUEST_BYTE
+            self.memory_budget.charge(memory)
+        # the empty documents skipped since the previous batch precede all documents which were not batched yet
+        empty_count, self.pending_empty_count = self.pending_empty_count, 0
+        return DocBatch(docs, [], [], [], [], memory, language, empty_count)
+
+    def skip_empty_docs(self, doc_stream):
+        for doc in doc_stream:
+            if any(doc.get(key, '').strip() for key in ('text', 'title', 'lead')):
+                yield doc
+                continue
+            self.empty_count += 1
+            self.pending_empty_count += 1
+            if self.fingerprints is not None:
+                self.store_fingerprints([doc])
+
+    def fit_doc_stream(self, doc_stream):
+        for doc in doc_stream:
+            if doc_request_size(doc) <= MAX_REQ_SIZE:
+                yield doc
+            elif self.params.oversized_docs == 'truncate':
+                self.truncated_count += 1
+                yield truncate_doc(doc, MAX_REQ_SIZE)
+            else:
+                yield from self.chunk_doc(doc)
+
+    def chunk_doc(self, doc):
+        # the title and the lead are sent only with the first chunk
+        head = truncate_doc(dict(doc, text=''), MAX_REQ_SIZE)
+        chunk_size = MAX_REQ_SIZE - doc_request_size(head)
+        self.chunked_count += 1
+        # the chunk IDs have an extra value, so that they can not collide with the ID of another document
+        id_vals = json.loads(doc['id'])
+        texts = list(split_text(doc['text'], chunk_size))
+        self.chunked_originals[doc['id']] = doc
+        for index, text in enumerate(texts):
+            chunk_id = json.dumps(id_vals + ['#{i}'.format(i=index)])
+            self.chunk_docs[chunk_id] = (doc['id'], index, len(texts))
+            yield dict(head, id=chunk_id, text=text) if index == 0 else {'id': chunk_id, 'text': text}
+
+    def merge_chunks(self, batch, batch_analysis):
+        # the chunks sent without an analysis failed
+        analyzed_ids = {doc_analysis['id'] for doc_analysis in batch_analysis}
+        for doc in batch.docs:
+            if doc['id'] in self.chunk_docs and doc['id'] not in analyzed_ids:
+                self.fail_chunk(doc['id'])
+
+        merged = []
+        for doc_analysis in batch_analysis:
+            chunk = self.chunk_docs.pop(doc_analysis['id'], None)
+            if chunk is None:
+                merged.append(doc_analysis)
+                continue
+            doc_id, index, count = chunk
+            if doc_id not in self.chunked_originals:
+                # another chunk of the document failed
+                continue
+            parts = self.chunk_parts[doc_id]
+            parts[index] = doc_analysis
+            # the chunks can be in different batches, the document is complete when the last one arrives
+            if len(parts) == count:
+                del self.chunk_parts[doc_id]
+                del self.chunked_originals[doc_id]
+                merged.append(merge_chunk_analyses(doc_id, [parts[i] for i in range(count)]))
+        return merged
+
+    def fail_chunk(self, chunk_id):
+        doc_id = self.chunk_docs.pop(chunk_id)[0]
+        doc = self.chunked_originals.pop(doc_id, None)
+        if doc is None:
+            return
+        self.chunk_parts.pop(doc_id, None)
+        self.failed_chunked_count += 1
+        if self.dead_letter is not None:
+            self.dead_letter.write([doc])
+
+    def format_memory_usage(self):
+        if self.memory_budget is None:
+            return ''
+        return ', {used:.1f} of {limit:.0f} MB in flight'.format(
+            used=self.memory_budget.used / 2 ** 20, limit=self.params.max_memory_mb)
+
+    def result_stream(self, batch_stream, req, *, url, user_key):
+        request_batch = self.async_request_batch if self.params.engine == 'async' else self.request_batch
+        with self.request_executor() as (executor, executor_params):
+            yield from parallel_map(
+                executor, request_batch,
+                batch_stream, itertools.repeat(req), url=url, user_key=user_key,
+                **executor_params, **self.get_request_params(), **self.get_parallel_map_params(executor)
+            )
+
+    @contextlib.contextmanager
+    def request_executor(self):
+        if self.shared is not None:
+            yield self.shared.executor
+        elif self.params.engine == 'async':
+            from async_engine import AsyncExecutor
+
+            with AsyncExecutor(max_in_flight=self.params.async_max_in_flight,
+                               connection_limit=self.params.async_connection_limit) as executor:
+                yield executor, {}
+        else:
+            import requests
+            from concurrent.futures import ThreadPoolExecutor
+
+            with requests.Session() as session:
+                with ThreadPoolExecutor(max_workers=self.params.thread_count) as executor:
+                    yield executor, {'session': session}
+
+    def get_request_params(self):
+        dead_letter = self.dead_letter
+        if dead_letter is not None and self.params.oversized_docs == 'chunk':
+            dead_letter = ChunkedDeadLetter(dead_letter, self.chunk_docs)
+        if self.deferred_dead_letter is not None:
+            dead_letter = self.deferred_dead_letter
+        return {
+            'retry': self.retry,
+            'limiter': self.limiter,
+            'dead_letter': dead_letter,
+            'metrics': self.metrics,
+            'stream': self.params.stream_responses,
+            'sink': self.write_analysis if self.direct_output else None
+        }
+
+    def get_parallel_map_params(self, executor):
+        lookahead = self.params.lookahead or None
+        if lookahead is None and self.shared is not None:
+            # the tables share the executor, each keeps an equal part of its queue filled, so none of them starves
+            lookahead = max(1, 2 * executor._max_workers // len(self.shared.table_apps))
+        return {
+            'lookahead': lookahead,
+            'ordered': self.params.ordered_output,
+            'reorder_buffer': self.params.reorder_buffer,
+            'budget': self.memory_budget
+        }
+
+    @staticmethod
+    def request_batch(batch, req, **kwargs):
+        docs = batch.docs
+        if not docs:
+            return batch, [], 0.0
+        if batch.language:
+            req = dict(req, language=batch.language)
+        start = time.perf_counter()
+        batch_analysis = list(make_batch_request(docs, req, **kwargs))
+        return batch, batch_analysis, time.perf_counter() - start
+
+    @staticmethod
+    async def async_request_batch(batch, req, **kwargs):
+        from async_engine import async_make_batch_request
+
+        docs = batch.docs
+        if not docs:
+            return batch, [], 0.0
+        if batch.language:
+            req = dict(req, language=batch.language)
+        start = time.perf_counter()
+        batch_analysis = await async_make_batch_request(docs, req, **kwargs)
+        return batch, batch_analysis, time.perf_counter() - start
+
+    def cache_lookup_stream(self, batch_stream, req):
+        cache_req = dict(req)
+        cache_req.pop('customerId', None)
+        for batch in batch_stream:
+            misses, keys, hits = [], [], []
+            for doc in batch.docs:
+                key = ResultCache.make_key(doc, cache_req)
+                doc_analysis = self.cache.get(key)
+                if doc_analysis is None:
+                    misses.append(doc)
+                    keys.append(key)
+                else:
+                    hits.append(doc_analysis)
+            yield batch._replace(docs=misses, cache_keys=keys, hits=hits)
+
+    def cache_results(self, batch, batch_analysis):
+        keys_by_id = self.keys_by_id(batch.docs, batch.cache_keys)
+        for doc_analysis in batch_analysis:
+            doc_keys = keys_by_id.get(doc_analysis['id'])
+            if doc_keys:
+                self.cache.put(doc_keys.popleft(), doc_analysis)
+
+    def dedup_lookup_stream(self, batch_stream):
+        for batch in batch_stream:
+            docs, cache_keys, dedup_keys, dups = [], [], [], []
+            for doc, cache_key in itertools.zip_longest(batch.docs, batch.cache_keys):
+                key = DedupIndex.make_key(doc)
+                if self.dedup.add(key):
+                    docs.append(doc)
+                    cache_keys.append(cache_key)
+                    dedup_keys.append(key)
+                else:
+                    dups.append((doc, key))
+            yield batch._replace(docs=docs, cache_keys=cache_keys if batch.cache_keys else [],
+                                 dedup_keys=dedup_keys, dups=dups)
 
-        with requests.Session() as session:
-            with ThreadPoolExecutor(max_workers=self.params.thread_count) as executor:
-                for batch_analysis in parallel_map(
-                    executor, make_batch_request,
-                    batch_stream, itertools.repeat(req), url=url, user_key=user_key,
-                    session=session
-                ):
-                    yield from batch_analysis
+    def dedup_results(self, batch, batch_analysis):
+        keys_by_id = self.keys_by_id(batch.docs, batch.dedup_keys)
+        resolved = []
+        for doc_analysis in batch_analysis:
+            doc_keys = keys_by_id.get(doc_analysis['id'])
+            if doc_keys:
+                key = doc_keys.popleft()
+                self.dedup.set_analysis(key, doc_analysis)
+                resolved.append(key)
+        # the documents without an analysis were either skipped as too large or failed
+        skipped_ids = set()
+        if any(keys_by_id.values()):
+            skipped_ids = {doc['id'] for doc in plan_batch_requests(batch.docs)[1]}
+        for doc_id, doc_keys in keys_by_id.items():
+            for key in doc_keys:
+                self.dedup.set(key, DEDUP_SKIPPED if doc_id in skipped_ids else DEDUP_FAILED)
+                resolved.append(key)
+
+        # the duplicates of a document still being analyzed (only with the unordered output) wait for its result
+        dup_analysis = []
+        for key in resolved:
+            for doc in self.dedup_waiters.pop(key, []):
+                dup_analysis.extend(self.resolve_dup(doc, key))
+        for doc, key in batch.dups:
+            dup_analysis.extend(self.resolve_dup(doc, key))
+        return dup_analysis
+
+    def resolve_dup(self, doc, key):
+        doc_analysis = self.dedup.get_analysis(key, doc['id'])
+        if doc_analysis == DEDUP_PENDING:
+            self.dedup_waiters[key].append(doc)
+            return []
+        if doc_analysis == DEDUP_SKIPPED and doc['id'] not in self.chunk_docs:
+            # the same as its original, the duplicate is only skipped, it would never succeed in a replay
+            print_skipped_doc(doc['id'])
+            self.metrics.count('skipped_documents')
+            return []
+        if doc_analysis in (DEDUP_FAILED, DEDUP_SKIPPED):
+            if doc['id'] in self.chunk_docs:
+                self.fail_chunk(doc['id'])
+            elif self.dead_letter is not None:
+                self.dead_letter.write([doc])
+            return []
+        self.unbilled_chars += int(doc_analysis['usedChars'])
+        return [doc_analysis]
+
+    @staticmethod
+    def keys_by_id(docs, keys):
+        keys_by_id = defaultdict(deque)
+        for doc, key in zip(docs, keys):
+            keys_by_id[doc['id']].append(key)
+        return keys_by_id
 
     def get_request(self):
         req = {
             'customerId': self.params.customer_id
         }
         if self.params.analysis_types:
-            req['analysisTypes'] = list(self.params.analysis_types)
+            req['analysisTypes'] = sorted(self.params.analysis_types)
         if self.params.language:
             req['language'] = self.params.language
         if self.params.domain:
@@ -258,178 +1279,143 @@ class AnalysisApp:
             req['returnMentions'] = True
         return req
 
-    def doc_batch_stream(self, row_stream):
-        for rows in slice_stream(row_stream, self.params.doc_batch_size):
-            yield list(map(self.row_to_doc, rows))
+    def doc_batch_stream(self, doc_stream):
+        if self.language_detector is not None:
+            yield from self.batcher.grouped_batches(
+                doc_stream, self.detect_doc_language, by_size=self.params.batching == 'size',
+                max_docs=self.params.doc_batch_size if self.params.batching == 'count' else None
+            )
+        elif self.params.batching == 'size':
+            for docs in self.batcher.batches(doc_stream):
+                yield None, docs
+        else:
+            for docs in slice_stream(doc_stream, self.params.doc_batch_size):
+                yield None, list(docs)
+
+    def detect_doc_language(self, doc):
+        return self.language_detector.detect(doc['text'] or doc.get('title', ''))
+
+    def replay_doc_stream(self):
+        dead_letter_path = self.params.get_dead_letter_path()
+        replay_path = self.params.get_dead_letter_replay_path()
+        if not os.path.exists(replay_path):
+            if not os.path.exists(dead_letter_path):
+                print('WARN: there are no failed documents to replay')
+                sys.stdout.flush()
+                return
+            os.replace(dead_letter_path, replay_path)
+        yield from read_dead_letters(replay_path)
 
     def row_to_doc(self, row):
-        def join_cols(columns):
-            return '\n\n'.join(row[col] for col in columns if row[col])
+        return row_to_doc(row, *self.get_doc_columns(), normalize=self.params.normalize_text)
 
-        doc = {
-            'id': json.dumps(list(row[id_col] for id_col in self.params.id_cols)),
-            'text': join_cols(self.params.text_cols)
-        }
-        if self.params.title_cols:
-            doc['title'] = join_cols(self.params.title_cols)
-        if self.params.lead_cols:
-            doc['lead'] = join_cols(self.params.lead_cols)
-        return doc
-
-    def analysis_to_doc_result(self, doc_analysis):
-        doc_ids_vals = zip(self.params.id_cols, json.loads(doc_analysis['id']))
-        doc_res = {
-            'language': doc_analysis['language'],
-            'usedChars': doc_analysis['usedChars']
-        }
-        for id_col, val in doc_ids_vals:
-            doc_res[id_col] = val
-        self.set_sentiment_fields(doc_res, doc_analysis)
-        yield doc_res
-
-    def analysis_to_snt_result(self, doc_analysis):
-        if 'sentences' in doc_analysis:
-            doc_ids_vals = list(zip(self.params.id_cols, json.loads(doc_analysis['id'])))
-            for index, snt in enumerate(doc_analysis['sentences']):
-                snt_res = {
-                    'index': index,
-                    'segment': snt['segment'],
-                    'text': snt['text']
-                }
-                self.set_sentiment_fields(snt_res, snt)
-                for id_col, val in doc_ids_vals:
-                    snt_res[id_col] = val
-                yield snt_res
-
-    def analysis_to_ent_result(self, doc_analysis):
-        if 'entities' in doc_analysis:
-            doc_ids_vals = list(zip(self.params.id_cols, json.loads(doc_analysis['id'])))
-            for ent in doc_analysis['entities']:
-                ent_res = {
-                    'type': ent['type'],
-                    'text': ent['text'],
-                    'score': ent['score'],
-                    'entityUid': ent.get('uid')
-                }
-                self.set_sentiment_fields(ent_res, ent)
-                for id_col, val in doc_ids_vals:
-                    ent_res[id_col] = val
-                yield ent_res
-
-    def analysis_to_rel_result(self, doc_analysis):
-        if 'relations' in doc_analysis:
-            doc_ids_vals = list(zip(self.params.id_cols, json.loads(doc_analysis['id'])))
-            for rel in doc_analysis['relations']:
-                rel_res = {
-                    'type': rel['type'],
-                    'name': rel['name'],
-                    'negated': rel['negated'],
-                    'subject': rel.get('subjectName'),
-                    'subjectType': rel.get('subjectType'),
-                    'subjectUid': rel.get('subjectUid'),
-                    'object': rel.get('objectName'),
-                    'objectType': rel.get('objectType'),
-                    'objectUid': rel.get('objectUid')
-                }
-                self.set_sentiment_fields(rel_res, rel)
-                for id_col, val in doc_ids_vals:
-                    rel_res[id_col] = val
-                yield rel_res
-
-    def analysis_to_full_result(self, doc_analysis):
-        if self.params.full_analysis_output:
-            full_res = {
-                'binaryData': serialize_data(doc_analysis)
-            }
-            for id_col, val in zip(self.params.id_cols, json.loads(doc_analysis['id'])):
-                full_res[id_col] = val
-            yield full_res
-
-    def set_sentiment_fields(self, res, obj):
-        if 'sentiment' in obj:
-            if obj['sentiment']['polarity'] > 0: label = 'positive'
-            elif obj['sentiment']['polarity'] < 0: label = 'negative'
-            else: label = 'neutral'
-            res['sentimentValue'] = obj['sentiment']['value']
-            res['sentimentPolarity'] = obj['sentiment']['polarity']
-            res['sentimentLabel'] = label
-            res['sentimentDetailedLabel'] = obj['sentiment']['label']
+    def get_doc_columns(self):
+        return self.params.id_cols, self.params.text_cols, self.params.title_cols, self.params.lead_cols
+
+    def get_input_columns(self):
+        all_cols = self.params.id_cols + self.params.text_cols + self.params.title_cols + self.params.lead_cols
+        return list(OrderedDict.fromkeys(all_cols))
+
+    def mapped_doc_stream(self):
+        # the rows are tuples of the input columns, the document columns are given as the indexes into them
+        columns = self.get_input_columns()
+        index_columns = [[columns.index(col) for col in doc_cols] for doc_cols in self.get_doc_columns()]
+        for row in read_csv_mapped(self.params.source_tab_path, columns):
+            yield row_to_doc(row, *index_columns, normalize=self.params.normalize_text)
+
+    def incremental_doc_stream(self, in_tab, fieldnames):
+        # the rows are read as tuples and an unchanged row is skipped before its document is made
+        req = self.get_request()
+        req.pop('customerId', None)
+        columns = self.get_input_columns()
+        index_columns = [[columns.index(col) for col in doc_cols] for doc_cols in self.get_doc_columns()]
+        config = [req, self.get_doc_columns(), self.params.normalize_text]
+        if self.params.mapped_input:
+            rows = read_csv_mapped(self.params.source_tab_path, columns)
         else:
-            res['sentimentValue'] = None
-            res['sentimentPolarity'] = None
-            res['sentimentLabel'] = None
-            res['sentimentDetailedLabel'] = None
+            rows = read_csv_tuples(in_tab, columns, fieldnames)
+        for row in rows:
+            doc_id = json.dumps([row[index] for index in index_columns[0]])
+            fingerprint = FingerprintIndex.make_fingerprint(row, config)
+            if not self.fingerprints.unchanged(doc_id, fingerprint):
+                self.pending_fingerprints[doc_id] = fingerprint
+                yield row_to_doc(row, *index_columns, normalize=self.params.normalize_text)
+
+    def store_fingerprints(self, batch_analysis):
+        for doc_analysis in batch_analysis:
+            fingerprint = self.pending_fingerprints.pop(doc_analysis['id'], None)
+            if fingerprint is not None:
+                self.fingerprints.put(doc_analysis['id'], fingerprint)
+
+    def sharded_doc_stream(self):
+        from concurrent.futures import ProcessPoolExecutor
+
+        path = self.params.source_tab_path
+        fieldnames = read_csv_header(path)
+        shards = csv_shards(path, self.params.reader_shard_size)
+        with ProcessPoolExecutor(max_workers=self.params.reader_processes) as executor:
+            for docs in parallel_map(executor, shard_to_docs, shards, itertools.repeat(fieldnames),
+                                     path=path, columns=self.get_doc_columns(),
+                                     normalize=self.params.normalize_text):
+                yield from docs
+
+    def analysis_to_doc_result(self, doc_analysis, id_values=None):
+        return doc_rows(doc_analysis, id_values or self.get_doc_id_values(doc_analysis))
+
+    def analysis_to_snt_result(self, doc_analysis, id_values=None):
+        return snt_rows(doc_analysis, id_values or self.get_doc_id_values(doc_analysis))
+
+    def analysis_to_ent_result(self, doc_analysis, id_values=None):
+        return ent_rows(doc_analysis, id_values or self.get_doc_id_values(doc_analysis))
+
+    def analysis_to_rel_result(self, doc_analysis, id_values=None):
+        return rel_rows(doc_analysis, id_values or self.get_doc_id_values(doc_analysis))
+
+    def analysis_to_full_result(self, doc_analysis, id_values=None):
+        if self.params.full_analysis_output:
+            yield (id_values or self.get_doc_id_values(doc_analysis)) + (self.serialize(doc_analysis),)
+
+    def get_doc_id_values(self, doc_analysis):
+        # the IDs of the document chunks have an extra value which is not written
+        return tuple(json.loads(doc_analysis['id'])[:len(self.params.id_cols)])
 
     def get_doc_tab_fields(self):
-        fields = self.params.id_cols + ['language']
-        fields += ['sentimentValue', 'sentimentPolarity', 'sentimentLabel', 'sentimentDetailedLabel']
-        fields += ['usedChars']
-        return fields
+        return self.params.id_cols + DOC_COLUMNS
 
     def get_snt_tab_fields(self):
-        fields = self.params.id_cols + ['index', 'segment', 'text']
-        fields += ['sentimentValue', 'sentimentPolarity', 'sentimentLabel', 'sentimentDetailedLabel']
-        return fields
+        return self.params.id_cols + SNT_COLUMNS
 
     def get_ent_tab_fields(self):
-        fields = self.params.id_cols + ['type', 'text', 'score', 'entityUid']
-        fields += ['sentimentValue', 'sentimentPolarity', 'sentimentLabel', 'sentimentDetailedLabel']
-        return fields
+        return self.params.id_cols + ENT_COLUMNS
 
     def get_rel_tab_fields(self):
-        fields = self.params.id_cols + ['type', 'name', 'negated']
-        fields += ['subject', 'object', 'subjectType', 'objectType', 'subjectUid', 'objectUid']
-        fields += ['sentimentValue', 'sentimentPolarity', 'sentimentLabel', 'sentimentDetailedLabel']
-        return fields
+        return self.params.id_cols + REL_COLUMNS
 
     def get_full_tab_fields(self):
-        return self.params.id_cols + ['binaryData']
+        return self.params.id_cols + FULL_COLUMNS
 
-    def write_manifest(self, *, doc_tab_path, snt_tab_path, ent_tab_path, rel_tab_path, full_tab_path):
-        with open(doc_tab_path + '.manifest', 'w', encoding='utf-8') as manifest_file:
-            tab_desc, cols_desc = self.get_table_desc_meta('documents-tab.json')
-            json.dump({
-                'primary_key': self.params.id_cols,
-                'incremental': True,
-                'metadata': [tab_desc],
-                'column_metadata': {col_name: [desc] for col_name, desc in cols_desc.items()}
-            }, manifest_file, indent=4)
-        with open(snt_tab_path + '.manifest', 'w', encoding='utf-8') as manifest_file:
-            tab_desc, cols_desc = self.get_table_desc_meta('sentences-tab.json')
-            json.dump({
-                'primary_key': self.params.id_cols + ['index'],
-                'incremental': True,
-                'metadata': [tab_desc],
-                'column_metadata': {col_name: [desc] for col_name, desc in cols_desc.items()}
-            }, manifest_file, indent=4)
-        with open(ent_tab_path + '.manifest', 'w', encoding='utf-8') as manifest_file:
-            tab_desc, cols_desc = self.get_table_desc_meta('entities-tab.json')
-            json.dump({
-                'primary_key': self.params.id_cols + ['type', 'text'],
-                'incremental': True,
-                'metadata': [tab_desc],
-                'column_metadata': {col_name: [desc] for col_name, desc in cols_desc.items()}
-            }, manifest_file, indent=4)
-        with open(rel_tab_path + '.manifest', 'w', encoding='utf-8') as manifest_file:
-            tab_desc, cols_desc = self.get_table_desc_meta('relations-tab.json')
-            json.dump({
-                'primary_key': self.params.id_cols + ['type', 'name', 'negated', 'subject', 'object'],
-                'incremental': True,
-                'metadata': [tab_desc],
-                'column_metadata': {col_name: [desc] for col_name, desc in cols_desc.items()}
-            }, manifest_file, indent=4)
-        with open(full_tab_path + '.manifest', 'w', encoding='utf-8') as manifest_file:
-            tab_desc, cols_desc = self.get_table_desc_meta('full-tab.json')
-            json.dump({
-                'primary_key': self.params.id_cols,
+    def write_manifest(self, table, tab_path):
+        with open(tab_path + '.manifest', 'w', encoding='utf-8') as manifest_file:
+            tab_desc, cols_desc = self.get_table_desc_meta(table.meta_filename)
+            manifest = {
+                'primary_key': self.params.id_cols + table.key_cols,
                 'incremental': True,
                 'metadata': [tab_desc],
                 'column_metadata': {col_name: [desc] for col_name, desc in cols_desc.items()}
-            }, manifest_file, indent=4)
+            }
+            if self.params.output_format != 'csv':
+                # the typed files have no header, their columns and types are declared in the manifest
+                fields = getattr(self, table.fields)()
+                manifest['columns'] = fields
+                for col_name in fields:
+                    manifest['column_metadata'].setdefault(col_name, []).append({
+                        'key': META_BASETYPE_KEY,
+                        'value': BASETYPES[COLUMN_TYPES.get(col_name, 'string')]
+                    })
+            json.dump(manifest, manifest_file, indent=4)
 
     def get_table_desc_meta(self, meta_filename):
-        with open(os.path.join(META_DIR, meta_filename), 'r', encoding='utf-8') as meta_file:
-            table_meta = json.load(meta_file)
+        table_meta = load_table_meta(meta_filename)
         tab_desc = {
             'key': META_DESC_KEY,
             'value': table_meta.get('description', '')
@@ -448,10 +1434,78 @@ class AnalysisApp:
         return tab_desc, cols_desc
 
     def write_usage(self, *, doc_count, used_chars):
-        usage_path = self.params.get_usage_path()
-        with open(usage_path, 'w', encoding='utf-8') as usage_file:
-            json.dump([
-                {'metric': 'documents', 'value': doc_count},
-                {'metric': 'characters', 'value': used_chars},
-                {'metric': 'processing_threads', 'value': self.params.thread_count}
-            ], usage_file, indent=4)
+        if self.shared is not None:
+            self.usage_counts = (doc_count, used_chars)
+            self.shared.write_tables_usage()
+            return
+        self.write_usage_file(self.get_usage(doc_count=doc_count, used_chars=used_chars))
+
+    def write_tables_usage(self):
+        totals = OrderedDict()
+        for table_app in self.table_apps:
+            doc_count, used_chars = table_app.usage_counts
+            for item in table_app.get_usage(doc_count=doc_count, used_chars=used_chars):
+                totals[item['metric']] = totals.get(item['metric'], 0) + item['value']
+        totals['processing_threads'] = self.params.thread_count
+        if 'avg_batch_fill' in totals:
+            batchers = [table_app.batcher for table_app in self.table_apps]
+            totals['avg_batch_fill'] = round(sum(batcher.batch_bytes for batcher in batchers) / sum(
+                batcher.batch_count * batcher.max_size for batcher in batchers), 4)
+        self.write_usage_file([{'metric': metric, 'value': value} for metric, value in totals.items()])
+
+    def get_usage(self, *, doc_count, used_chars):
+        usage = [
+            {'metric': 'documents', 'value': doc_count},
+            {'metric': 'characters', 'value': used_chars},
+            {'metric': 'processing_threads', 'value': self.params.thread_count}
+        ]
+        if self.batcher.batch_count:
+            usage += [
+                {'metric': 'requests', 'value': self.batcher.batch_count},
+                {'metric': 'avg_batch_fill', 'value': round(self.batcher.avg_fill(), 4)}
+            ]
+        if self.empty_count:
+            usage += [
+                {'metric': 'empty_documents', 'value': self.empty_count}
+            ]
+        if self.truncated_count or self.chunked_count:
+            usage += [
+                {'metric': 'truncated_documents', 'value': self.truncated_count},
+                {'metric': 'chunked_documents', 'value': self.chunked_count}
+            ]
+        if self.fingerprints is not None:
+            usage += [
+                {'metric': 'incremental_skipped_documents', 'value': self.fingerprints.skipped}
+            ]
+        if self.dedup is not None:
+            usage += [
+                {'metric': 'dedup_documents', 'value': self.dedup.dup_count},
+                {'metric': 'dedup_characters', 'value': self.dedup.saved_chars}
+            ]
+        if self.cache is not None:
+            usage += [
+                {'metric': 'cache_hits', 'value': self.cache.hits},
+                {'metric': 'cache_misses', 'value': self.cache.misses}
+            ]
+
+        return usage
+
+    def write_usage_file(self, usage):
+        # the tables report their usage from their own threads
+        with self.report_lock:
+            write_json_atomic(self.params.get_usage_path(), usage)
+
+    def write_metrics(self):
+        if self.shared is not None:
+            return self.shared.write_metrics()
+        metrics = self.metrics.snapshot()
+        metrics['counters'].update({
+            'retries': self.retry.retry_count,
+            'throttled_requests': self.limiter.throttle_count if self.limiter is not None else 0,
+            'dead_letter_documents': sum(app.dead_letter.doc_count for app in self.table_apps or [self]
+                                         if app.dead_letter is not None)
+        })
+        if self.memory_budget is not None:
+            metrics['memory_in_flight_bytes'] = {'current': self.memory_budget.used, 'peak': self.memory_budget.peak}
+        with self.report_lock:
+            write_json_atomic(self.params.get_metrics_path(), metrics)
@@ -0,0 +1,162 @@
+# coding=utf-8
+# Python 3
+
+import asyncio
+import functools
+import json
+import threading
+import time
+
+import aiohttp
+
+from kbc_tools import (MAX_REQ_SIZE, CONNECT_TIMEOUT, READ_TIMEOUT, RETRY_CODES, THROTTLE_CODES, STREAM_CHUNK_SIZE,
+                       JsonArrayDecoder, BatchSink, batch_request_size, finish_batch_request, sink_values,
+                       batch_request, request_headers, parse_retry_after, print_skipped_doc,
+                       print_http_error, print_request_exception, observe_response)
+
+LIMITER_POLL_INTERVAL = 0.05
+
+
+class AsyncExecutor:
+
+    def __init__(self, *, max_in_flight, connection_limit):
+        # parallel_map keeps twice as many submitted requests as there are "workers"
+        self._max_workers = max(1, max_in_flight // 2)
+        self.connection_limit = connection_limit
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name='async-engine', daemon=True)
+        self.thread.start()
+        self.session = self.call(self.open_session())
+
+    def call(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    async def open_session(self):
+        connector = aiohttp.TCPConnector(limit=self.connection_limit, keepalive_timeout=60)
+        timeout = aiohttp.ClientTimeout(sock_connect=CONNECT_TIMEOUT, sock_read=READ_TIMEOUT)
+        return aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+    def submit(self, fn, *args, **kwargs):
+        return asyncio.run_coroutine_threadsafe(fn(*args, session=self.session, **kwargs), self.loop)
+
+    def shutdown(self):
+        self.call(self.session.close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+
+
+async def async_make_batch_request(batch, req_obj, *, url, user_key, doc_id_key='id', docs_key='documents', session,
+                                   retry=None, limiter=None, dead_letter=None, metrics=None, stream=False, sink=None):
+    size = batch_request_size(batch)
+    if size > MAX_REQ_SIZE:
+        if len(batch) == 1:
+            print_skipped_doc(batch[0][doc_id_key])
+            if metrics is not None:
+                metrics.count('skipped_documents')
+            return []
+
+        half = len(batch) // 2
+        first, second = await asyncio.gather(
+            async_make_batch_request(batch[:half], req_obj, url=url, user_key=user_key, doc_id_key=doc_id_key,
+                docs_key=docs_key, session=session, retry=retry, limiter=limiter, dead_letter=dead_letter,
+                metrics=metrics, stream=stream, sink=sink),
+            async_make_batch_request(batch[half:], req_obj, url=url, user_key=user_key, doc_id_key=doc_id_key,
+                docs_key=docs_key, session=session, retry=retry, limiter=limiter, dead_letter=dead_letter,
+                metrics=metrics, stream=stream, sink=sink)
+        )
+        return first + second
+
+    batch_sink = BatchSink(batch, sink, doc_id_key) if sink is not None else None
+    res = await async_json_post(url, request_headers(user_key), batch_request(batch, req_obj, docs_key, doc_id_key),
+                                session=session, retry=retry, limiter=limiter, metrics=metrics, stream=stream,
+                                sink=batch_sink)
+    return finish_batch_request(res, batch, batch_sink, doc_id_key=doc_id_key, metrics=metrics,
+                                dead_letter=dead_letter)
+
+
+async def async_json_post(url, headers, data, *, session, retry=None, limiter=None, metrics=None, stream=False,
+                          sink=None):
+    start = time.perf_counter()
+    body = json.dumps(data)
+    if metrics is not None:
+        metrics.add_time('encode_request', time.perf_counter() - start)
+    attempt = 0
+    while True:
+        retry_after = None
+        if limiter is not None:
+            while not limiter.try_acquire():
+                await asyncio.sleep(LIMITER_POLL_INTERVAL)
+        try:
+            code, response_headers, content = await async_read_post(url, headers=headers, data=body, session=session,
+                                                                    metrics=metrics, stream=stream, sink=sink)
+            if code < 400:
+                if limiter is not None:
+                    limiter.on_success()
+                if stream:
+                    return content
+                if metrics is None:
+                    return json.loads(content)
+                with metrics.timer('decode_response'):
+                    return json.loads(content)
+
+            if limiter is not None and code in THROTTLE_CODES:
+                limiter.on_throttle()
+            retryable = code in RETRY_CODES
+            retry_after = parse_retry_after(response_headers.get('Retry-After'))
+            print_error = functools.partial(print_http_error, code, content.decode('utf-8', errors='replace'))
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            retryable = True
+            print_error = functools.partial(print_request_exception, e)
+        finally:
+            if limiter is not None:
+                limiter.release()
+
+        delay = None
+        if retry is not None and retryable and attempt < retry.max_retries:
+            delay = retry.next_delay(attempt, retry_after)
+        if delay is None:
+            print_error()
+            return []
+        await asyncio.sleep(delay)
+        attempt += 1
+
+
+async def async_read_post(url, *, headers, data, session, metrics=None, stream=False, sink=None):
+    if metrics is not None:
+        metrics.request_started()
+    start = time.perf_counter()
+    end = None
+    received = 0
+    try:
+        async with session.post(url, headers=headers, data=data) as response:
+            if stream and response.status < 400:
+                # the latency of a streamed response is the time to its headers, the rest is its decoding
+                end = time.perf_counter()
+                decoder = JsonArrayDecoder()
+                content = await async_decode_json_stream(response, decoder, sink)
+                received = decoder.byte_count
+                if metrics is not None:
+                    metrics.add_time('decode_response', time.perf_counter() - end)
+            else:
+                content = await response.read()
+                received = len(content)
+            return response.status, response.headers, content
+    finally:
+        if metrics is not None:
+            observe_response(metrics, (end or time.perf_counter()) - start, sent=len(data), received=received)
+
+
+async def async_decode_json_stream(response, decoder, sink=None):
+    # the sink is called on the event loop, a full writer queue holds back the reading of all the responses
+    values = []
+    async for chunk in response.content.iter_chunked(STREAM_CHUNK_SIZE):
+        values += sink_values(decoder.feed(chunk), sink)
+    values += sink_values(decoder.close(), sink)
+    return values
@@ -0,0 +1,77 @@
+# coding=utf-8
+# Python 3
+
+import math
+
+from kbc_tools import plan_batch_requests, batch_request_size
+
+# the client thread counts the wall time is projected for, besides the configured one
+PROJECTED_THREAD_COUNTS = (1, 2, 4, 8, 16, 32)
+
+
+def doc_chars(doc):
+    # the characters the API counts as used for a document
+    return sum(len(doc.get(key) or '') for key in ('title', 'lead', 'text'))
+
+
+class CostEstimate:
+
+    def __init__(self):
+        self.doc_count = 0
+        self.input_chars = 0
+        self.batched_count = 0
+        self.dup_count = 0
+        self.dup_chars = 0
+        self.skipped_count = 0
+        self.request_count = 0
+        self.request_bytes = 0
+        self.chars = 0
+
+    def count_docs(self, doc_stream):
+        for doc in doc_stream:
+            self.doc_count += 1
+            self.input_chars += doc_chars(doc)
+            yield doc
+
+    def add_duplicate(self, doc):
+        self.dup_count += 1
+        self.dup_chars += doc_chars(doc)
+
+    def add_batch(self, docs, sent):
+        self.batched_count += len(docs)
+        if not sent:
+            return
+        requests, skipped = plan_batch_requests(sent)
+        self.request_count += len(requests)
+        self.request_bytes += sum(map(batch_request_size, requests))
+        self.skipped_count += len(skipped)
+        self.chars += sum(map(doc_chars, sent)) - sum(map(doc_chars, skipped))
+
+    def dup_ratio(self):
+        return self.dup_count / self.batched_count if self.batched_count else 0.0
+
+    def project_wall_time(self, latency, thread_count, input_seconds=0.0):
+        # the requests of similar sizes are sent in waves of the thread count, the input is read meanwhile,
+        # so the slower of the two bounds the run
+        return max(input_seconds, math.ceil(self.request_count / thread_count) * latency)
+
+    def snapshot(self, *, latency=None, thread_counts=(), input_seconds=0.0):
+        estimate = {
+            'documents': self.doc_count,
+            'input_characters': self.input_chars,
+            'characters': self.chars,
+            'requests': self.request_count,
+            'mean_request_bytes': round(self.request_bytes / self.request_count) if self.request_count else 0,
+            'oversized_skipped_documents': self.skipped_count,
+            'duplicate_documents': self.dup_count,
+            'duplicate_characters': self.dup_chars,
+            'duplicate_ratio': round(self.dup_ratio(), 4),
+            'input_seconds': round(input_seconds, 3)
+        }
+        if latency is not None:
+            estimate['request_latency_seconds'] = latency
+            estimate['projected_wall_seconds'] = {
+                str(thread_count): round(self.project_wall_time(latency, thread_count, input_seconds), 1)
+                for thread_count in thread_counts
+            }
+        return estimate
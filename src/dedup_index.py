@@ -0,0 +1,88 @@
+# coding=utf-8
+# Python 3
+
+import hashlib
+import json
+import os
+import sqlite3
+import zlib
+
+from collections import OrderedDict
+
+DEDUP_MEMORY_ENTRIES = 100000
+
+PENDING = b''
+FAILED = b'\0'
+SKIPPED = b'\1'
+
+
+class DedupIndex:
+
+    def __init__(self, *, memory_entries=DEDUP_MEMORY_ENTRIES, spill_dir=None):
+        self.memory_entries = memory_entries
+        self.spill_dir = spill_dir
+        self.memory = OrderedDict()
+        self.conn = None
+        self.spill_path = None
+        self.dup_count = 0
+        self.saved_chars = 0
+
+    @staticmethod
+    def make_key(doc):
+        content = json.dumps({key: val for key, val in doc.items() if key != 'id'}, sort_keys=True, ensure_ascii=False)
+        return hashlib.blake2b(content.encode('utf-8'), digest_size=16).digest()
+
+    def get(self, key):
+        if key in self.memory:
+            return self.memory[key]
+        if self.conn is not None:
+            row = self.conn.execute('SELECT value FROM docs WHERE key = ?', (key,)).fetchone()
+            if row is not None:
+                return row[0]
+        return None
+
+    def add(self, key):
+        if key in self.memory or self.get(key) is not None:
+            return False
+        self.set(key, PENDING)
+        return True
+
+    def set(self, key, value):
+        self.memory[key] = value
+        self.memory.move_to_end(key)
+        if len(self.memory) > self.memory_entries:
+            self.spill()
+
+    def set_analysis(self, key, doc_analysis):
+        value = {k: v for k, v in doc_analysis.items() if k != 'id'}
+        self.set(key, zlib.compress(json.dumps(value, ensure_ascii=False).encode('utf-8')))
+
+    def get_analysis(self, key, doc_id):
+        value = self.get(key)
+        if value is None or value in (PENDING, FAILED, SKIPPED):
+            return value
+        doc_analysis = json.loads(zlib.decompress(value).decode('utf-8'))
+        doc_analysis['id'] = doc_id
+        self.dup_count += 1
+        self.saved_chars += int(doc_analysis['usedChars'])
+        return doc_analysis
+
+    def spill(self):
+        if self.conn is None:
+            # only the large inputs spill, tempfile imports shutil with the compression modules
+            import tempfile
+
+            fd, self.spill_path = tempfile.mkstemp(prefix='dedup-', suffix='.sqlite', dir=self.spill_dir)
+            os.close(fd)
+            self.conn = sqlite3.connect(self.spill_path)
+            self.conn.execute('CREATE TABLE docs (key BLOB PRIMARY KEY, value BLOB NOT NULL)')
+        spilled = [self.memory.popitem(last=False) for _ in range(len(self.memory) // 2)]
+        self.conn.executemany('INSERT OR REPLACE INTO docs (key, value) VALUES (?, ?)', spilled)
+        self.conn.commit()
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+            os.unlink(self.spill_path)
+        self.memory.clear()
@@ -0,0 +1,58 @@
+# coding=utf-8
+# Python 3
+
+import hashlib
+import json
+import sqlite3
+
+
+class FingerprintIndex:
+
+    def __init__(self, path):
+        self.path = path
+        self.skipped = 0
+        self.updated = 0
+
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('PRAGMA synchronous = NORMAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS fingerprints ('
+            '  id_key BLOB PRIMARY KEY,'
+            '  fingerprint BLOB NOT NULL'
+            ') WITHOUT ROWID'
+        )
+        self.conn.commit()
+
+    @staticmethod
+    def make_id_key(doc_id):
+        return hashlib.blake2b(doc_id.encode('utf-8'), digest_size=12).digest()
+
+    @staticmethod
+    def make_fingerprint(row, config):
+        # the fingerprint of the raw values of the input columns, the configuration (the request and the columns
+        # of the document) is a part of it, so a change of the analysis types re-analyzes all documents
+        content = json.dumps([config, row], sort_keys=True, ensure_ascii=False)
+        return hashlib.blake2b(content.encode('utf-8'), digest_size=16).digest()
+
+    def unchanged(self, doc_id, fingerprint):
+        row = self.conn.execute(
+            'SELECT fingerprint FROM fingerprints WHERE id_key = ?', (self.make_id_key(doc_id),)
+        ).fetchone()
+        if row is not None and row[0] == fingerprint:
+            self.skipped += 1
+            return True
+        return False
+
+    def put(self, doc_id, fingerprint):
+        self.conn.execute(
+            'INSERT OR REPLACE INTO fingerprints (id_key, fingerprint) VALUES (?, ?)',
+            (self.make_id_key(doc_id), fingerprint)
+        )
+        self.updated += 1
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        # uncommitted fingerprints are rolled back, a failed job analyzes the same documents again
+        self.conn.close()
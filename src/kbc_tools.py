@@ -2,23 +2,65 @@
 # Python 3
 
 import base64
-import bz2
+import codecs
 import csv
+import functools
+import io
 import itertools
 import json
-import pickle
+import mmap
+import operator
+import os
+import queue
+import random
+import re
 import sys
+import threading
+import time
+import zlib
 
 from collections import deque
 
-import requests
-
 MAX_REQ_SIZE = 100 * 1024
+# the documents are sent with their positions in the batch as IDs, this many characters at most
+SENT_ID_SIZE = 6
 CONNECT_TIMEOUT = 10.01
 READ_TIMEOUT = 128
+MIN_BATCH_SIZE = 4 * 1024
+CSV_SHARD_SIZE = 16 * 1024 * 1024
+MAPPED_BLOCK_SIZE = 4 * 1024 * 1024
+WRITER_QUEUE_SIZE = 16
+OUTPUT_BUFFER_SIZE = 1024 * 1024
+
+CODEC_PICKLE_BZ2 = 'pickle-bz2'
+CODEC_JSON_ZLIB = 'json-zlib'
+CODEC_JSON_ZSTD = 'json-zstd'
+CODEC_HEADERS = {CODEC_JSON_ZLIB: 'jz1', CODEC_JSON_ZSTD: 'js1'}
+CODEC_BY_HEADER = {header + ':': codec for codec, header in CODEC_HEADERS.items()}
+CODECS = frozenset([CODEC_PICKLE_BZ2]) | frozenset(CODEC_HEADERS)
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 3
+DICTIONARY_SIZE = 64 * 1024
+ZLIB_DICTIONARY_SIZE = 32 * 1024
+ADAPTIVE_WINDOW = 8
+ADAPTIVE_STEP = 1.25
+MAX_RETRIES = 3
+RETRY_BACKOFF = 1.0
+RETRY_MAX_BACKOFF = 60.0
+RETRY_AFTER_LIMIT = 600.0
+RETRY_CODES = frozenset([408, 429, 500, 502, 503, 504])
+THROTTLE_CODES = frozenset([429, 503])
+THROTTLE_COOLDOWN = 1.0
+STREAM_CHUNK_SIZE = 64 * 1024
+JSON_WHITESPACE = re.compile(r'[ \t\n\r]*')
 
 csv.field_size_limit(1024 * MAX_REQ_SIZE)
 
+# the dialect of the KBC tables is registered also by keboola.docker, which is imported only by the main process,
+# not by the reader processes started by spawn or forkserver
+if 'kbc' not in csv.list_dialects():
+    csv.register_dialect('kbc', lineterminator='\n', delimiter=',', quotechar='"')
+
 
 def slice_stream(iterator, size):
     while True:
@@ -29,12 +71,14 @@ def slice_stream(iterator, size):
             yield chunk
 
 
-def read_csv(input_file):
+def read_csv(input_file, fieldnames=None):
     safe_input = (line.replace('\0', '') for line in input_file)
-    reader = csv.DictReader(safe_input, dialect='kbc')
+    reader = csv.DictReader(safe_input, fieldnames=fieldnames, dialect='kbc')
     while True:
         try:
             yield next(reader)
+        except StopIteration:
+            return
         except csv.Error as e:
             print(
                 'could not properly read some row(s) for the input data',
@@ -44,111 +88,949 @@ def read_csv(input_file):
             sys.stderr.flush()
 
 
-def csv_writer(output_file, *, fields):
-    writer = csv.DictWriter(output_file, fieldnames=fields, dialect='kbc')
-    writer.writeheader()
-    return writer
+def read_csv_projected(input_file, columns, fieldnames=None):
+    return (dict(zip(columns, row)) for row in read_csv_tuples(input_file, columns, fieldnames))
 
 
-def make_batch_request(batch, req_obj, *, url, user_key, doc_id_key='id', docs_key='documents', session=None):
-    size = sum(len(doc[key]) for doc in batch for key in doc)
-    if size > MAX_REQ_SIZE:
-        if len(batch) == 1:
+def read_csv_tuples(input_file, columns, fieldnames=None):
+    # the tuples of the values of the columns, the missing values of short rows are None
+    safe_input = (line.replace('\0', '') for line in input_file)
+    reader = csv.reader(safe_input, dialect='kbc')
+    header = fieldnames or next(reader, None)
+    if header is None:
+        return
+    indexes = [header.index(col) for col in columns]
+    while True:
+        try:
+            row = next(reader)
+        except StopIteration:
+            return
+        except csv.Error as e:
             print(
-                'skipping too large document with ID={id}'.format(id=batch[0][doc_id_key]),
-                'the maximum allowed size is {max} bytes'.format(max=MAX_REQ_SIZE),
+                'could not properly read some row(s) for the input data',
+                'CSV read error, {type}: {e}'.format(type=type(e).__name__, e=e),
                 sep='\n', file=sys.stderr
             )
             sys.stderr.flush()
+            continue
+        if row:
+            yield tuple(row[index] if index < len(row) else None for index in indexes)
+
+
+def read_csv_mapped(path, columns, *, block_size=MAPPED_BLOCK_SIZE):
+    # the tuples of the values of the columns, the file is memory mapped and parsed in blocks of whole records,
+    # the NUL characters are removed from a whole block at once and only when there are any
+    with open(path, 'rb') as input_file:
+        if os.fstat(input_file.fileno()).st_size == 0:
+            return
+        with mmap.mmap(input_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            start = mapped_record_end(data, 0, 0)
+            header = next(block_reader(data[:start]), [])
+            indexes = [header.index(col) for col in columns]
+            width = max(indexes) + 1
+            project = operator.itemgetter(*indexes) if len(indexes) > 1 else lambda row: (row[indexes[0]],)
+            while start < len(data):
+                block = data[start:start + block_size]
+                end = mapped_record_end(data, start + len(block), block.count(b'"') % 2)
+                if end > start + len(block):
+                    block += data[start + len(block):end]
+                start = end
+                reader = block_reader(block)
+                while True:
+                    try:
+                        row = next(reader)
+                    except StopIteration:
+                        break
+                    except csv.Error as e:
+                        print(
+                            'could not properly read some row(s) for the input data',
+                            'CSV read error, {type}: {e}'.format(type=type(e).__name__, e=e),
+                            sep='\n', file=sys.stderr
+                        )
+                        sys.stderr.flush()
+                        continue
+                    if row:
+                        if len(row) < width:
+                            row += [None] * (width - len(row))
+                        yield project(row)
+
+
+def mapped_record_end(data, pos, quote_parity):
+    # the same as record_end, on the memory mapped file
+    while True:
+        line_end = data.find(b'\n', pos)
+        if line_end < 0:
+            return len(data)
+        quote_parity = (quote_parity + data[pos:line_end].count(b'"')) % 2
+        pos = line_end + 1
+        if quote_parity == 0:
+            return pos
+
+
+def block_reader(block):
+    if b'\0' in block:
+        block = block.replace(b'\0', b'')
+    return csv.reader(io.TextIOWrapper(io.BytesIO(block), encoding='utf-8'), dialect='kbc')
+
+
+def read_csv_header(path):
+    with open(path, 'r', encoding='utf-8') as input_file:
+        safe_input = (line.replace('\0', '') for line in input_file)
+        return next(csv.reader(safe_input, dialect='kbc'), [])
+
+
+def read_csv_fieldnames(input_file):
+    # only the header line is read, the rows follow with read_csv(input_file, fieldnames)
+    return next(csv.reader([input_file.readline().replace('\0', '')], dialect='kbc'), [])
+
+
+def csv_shards(path, shard_size=CSV_SHARD_SIZE):
+    with open(path, 'rb') as input_file:
+        start = record_end(input_file, 0)
+        while True:
+            input_file.seek(start)
+            chunk = input_file.read(shard_size)
+            if not chunk:
+                return
+            if len(chunk) < shard_size:
+                yield start, start + len(chunk)
+                return
+            end = record_end(input_file, chunk.count(b'"') % 2)
+            yield start, end
+            start = end
+
+
+def record_end(input_file, quote_parity):
+    # a line break is a record boundary only outside of a quoted field, i.e. after an even number of quotes,
+    # the quote byte can not be a part of a multi-byte UTF-8 character and an escaped quote is doubled
+    while True:
+        line = input_file.readline()
+        if not line:
+            return input_file.tell()
+        quote_parity = (quote_parity + line.count(b'"')) % 2
+        if quote_parity == 0:
+            return input_file.tell()
+
+
+def read_csv_shard(path, start, end, fieldnames):
+    with open(path, 'rb') as input_file:
+        input_file.seek(start)
+        data = input_file.read(end - start)
+    return list(read_csv(io.TextIOWrapper(io.BytesIO(data), encoding='utf-8'), fieldnames=fieldnames))
+
+
+def csv_writer(output_file, *, fields, header=True):
+    # the rows are tuples of the values in the order of the fields
+    writer = csv.writer(output_file, dialect='kbc')
+    if header:
+        writer.writerow(fields)
+    return writer
+
+
+def open_output(path, *, resume_size=None, buffer_size=-1):
+    if resume_size is None:
+        return open(path, 'w', encoding='utf-8', buffering=buffer_size)
+    output_file = open(path, 'r+', encoding='utf-8', buffering=buffer_size)
+    output_file.truncate(resume_size)
+    output_file.seek(0, os.SEEK_END)
+    return output_file
+
+
+class TableWriter:
+
+    def __init__(self, output_file, *, fields, flatten, header=True, queue_size=WRITER_QUEUE_SIZE, name=None,
+                 metrics=None, row_writer=None):
+        self.output_file = output_file
+        # the rows are written as CSV unless another writer with the "writerows" and "close" methods is given
+        self.row_writer = row_writer
+        self.writer = row_writer if row_writer is not None else csv_writer(output_file, fields=fields, header=header)
+        self.flatten = flatten
+        self.name = name or getattr(output_file, 'name', 'table')
+        self.metrics = metrics
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.error = None
+        self.thread = threading.Thread(target=self.work, name='table-writer', daemon=True)
+        self.thread.start()
+
+    def work(self):
+        while True:
+            task = self.queue.get()
+            try:
+                if task is None:
+                    return
+                items, done = task
+                if self.error is None:
+                    if self.metrics is None:
+                        for args in items:
+                            self.writer.writerows(self.flatten(*args))
+                    else:
+                        self.write_measured(items)
+                if done is not None:
+                    done()
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def write_measured(self, items):
+        start = time.perf_counter()
+        rows = [row for args in items for row in self.flatten(*args)]
+        flattened = time.perf_counter()
+        self.writer.writerows(rows)
+        self.metrics.add_time('flatten ' + self.name, flattened - start)
+        self.metrics.add_time('write ' + self.name, time.perf_counter() - flattened)
+
+    def write(self, items, done=None):
+        self.check()
+        self.queue.put((items, done))
+
+    def join(self):
+        self.queue.join()
+        self.check()
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        if self.row_writer is not None:
+            self.row_writer.close()
+            self.row_writer = None
+        self.check()
+
+    def check(self):
+        if self.error is not None:
+            raise self.error
+
+
+def flushed_size(output_file):
+    output_file.flush()
+    return os.fstat(output_file.fileno()).st_size
+
+
+def write_json_atomic(path, obj):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as tmp_file:
+        json.dump(obj, tmp_file, indent=4)
+    os.replace(tmp_path, path)
+
+
+def batch_request_size(batch):
+    return sum(map(doc_request_size, batch))
+
+
+def doc_request_size(doc, doc_id_key='id'):
+    return sum(len(value) for key, value in doc.items() if key != doc_id_key) + SENT_ID_SIZE
+
+
+class DocBatcher:
+
+    def __init__(self, *, max_size=MAX_REQ_SIZE, max_docs=None, adaptive=False, min_size=MIN_BATCH_SIZE):
+        self.max_size = max_size
+        self.min_size = min(min_size, max_size)
+        self.max_docs = max_docs
+        self.adaptive = adaptive
+        self.target_size = max_size
+        self.batch_count = 0
+        self.batch_bytes = 0
+
+        # hill climbing of the target batch size on the observed throughput of the API requests
+        self.direction = -1
+        self.window = []
+        self.last_throughput = None
+
+    def batches(self, doc_stream):
+        batch, size = [], 0
+        for doc in doc_stream:
+            doc_size = doc_request_size(doc)
+            if batch and (size + doc_size > self.target_size or (self.max_docs and len(batch) >= self.max_docs)):
+                yield batch
+                batch, size = [], 0
+            batch.append(doc)
+            size += doc_size
+        if batch:
+            yield batch
+
+    def grouped_batches(self, doc_stream, key, *, by_size=True, max_docs=None):
+        # separate batches for each group, each is sent as soon as it is full, the rest at the end of the stream
+        max_docs = max_docs or self.max_docs
+        pending = {}
+        for doc in doc_stream:
+            group = key(doc)
+            doc_size = doc_request_size(doc)
+            batch, size = pending.get(group, ([], 0))
+            if batch and ((by_size and size + doc_size > self.target_size)
+                          or (max_docs and len(batch) >= max_docs)):
+                yield group, batch
+                batch, size = [], 0
+            batch.append(doc)
+            pending[group] = (batch, size + doc_size)
+        for group, (batch, _) in pending.items():
+            yield group, batch
+
+    def observe(self, size, latency):
+        self.batch_count += 1
+        self.batch_bytes += size
+        if not self.adaptive or latency <= 0:
+            return
+
+        self.window.append((size, latency))
+        if len(self.window) < ADAPTIVE_WINDOW:
+            return
+        throughput = sum(s for s, _ in self.window) / sum(l for _, l in self.window)
+        self.window = []
+        if self.last_throughput is not None and throughput < self.last_throughput:
+            self.direction = -self.direction
+        self.last_throughput = throughput
+        step = ADAPTIVE_STEP if self.direction > 0 else 1 / ADAPTIVE_STEP
+        self.target_size = int(max(self.min_size, min(self.max_size, self.target_size * step)))
+
+    def avg_fill(self):
+        if not self.batch_count:
+            return 0.0
+        return self.batch_bytes / (self.batch_count * self.max_size)
+
+
+def print_skipped_doc(doc_id):
+    print(
+        'skipping too large document with ID={id}'.format(id=doc_id),
+        'the maximum allowed size is {max} bytes'.format(max=MAX_REQ_SIZE),
+        sep='\n', file=sys.stderr
+    )
+    sys.stderr.flush()
+
+
+def print_failed_docs(doc_ids):
+    print('failed to process documents: {ids}'.format(ids=' '.join(doc_ids)), file=sys.stdout)
+    print('if the problems persist, please contact our support at support@geneea.com', file=sys.stderr)
+    sys.stderr.flush()
+
+
+def print_http_error(code, body):
+    try:
+        err = json.loads(body)
+        print(
+            'Internal error while communicating with the analysis API.',
+            'HTTP error {code}, {e}: {msg}'.format(code=code, e=err['exception'], msg=err['message']),
+            sep='\n', file=sys.stderr
+        )
+    except (ValueError, LookupError, TypeError):
+        print(
+            'Internal error while communicating with the analysis API.',
+            'HTTP error {code}'.format(code=code),
+            '{body}'.format(body=body),
+            sep='\n', file=sys.stderr
+        )
+
+
+def print_request_exception(e):
+    print(
+        'Internal error while communicating with the analysis API.',
+        'HTTP request exception, {type}: {e}'.format(type=type(e).__name__, e=e),
+        sep='\n', file=sys.stderr
+    )
+
+
+def make_batch_request(batch, req_obj, *, url, user_key, doc_id_key='id', docs_key='documents', session=None,
+                       retry=None, limiter=None, dead_letter=None, metrics=None, stream=False, sink=None):
+    size = batch_request_size(batch)
+    if size > MAX_REQ_SIZE:
+        if len(batch) == 1:
+            print_skipped_doc(batch[0][doc_id_key])
+            if metrics is not None:
+                metrics.count('skipped_documents')
             return []
 
         half = len(batch) // 2
         return itertools.chain(
-            make_batch_request(batch[:half], req_obj, url=url,
-                user_key=user_key, doc_id_key=doc_id_key, docs_key=docs_key, session=session),
-            make_batch_request(batch[half:], req_obj, url=url,
-                user_key=user_key, doc_id_key=doc_id_key, docs_key=docs_key, session=session)
+            make_batch_request(batch[:half], req_obj, url=url, user_key=user_key, doc_id_key=doc_id_key,
+                docs_key=docs_key, session=session, retry=retry, limiter=limiter, dead_letter=dead_letter,
+                metrics=metrics, stream=stream, sink=sink),
+            make_batch_request(batch[half:], req_obj, url=url, user_key=user_key, doc_id_key=doc_id_key,
+                docs_key=docs_key, session=session, retry=retry, limiter=limiter, dead_letter=dead_letter,
+                metrics=metrics, stream=stream, sink=sink)
         )
 
-    headers = {
+    batch_sink = BatchSink(batch, sink, doc_id_key) if sink is not None else None
+    res = json_post(url, request_headers(user_key), batch_request(batch, req_obj, docs_key, doc_id_key),
+                    session=session, retry=retry, limiter=limiter, metrics=metrics, stream=stream, sink=batch_sink)
+    return finish_batch_request(res, batch, batch_sink, doc_id_key=doc_id_key, metrics=metrics,
+                                dead_letter=dead_letter)
+
+
+def finish_batch_request(res, batch, batch_sink, *, doc_id_key, metrics, dead_letter):
+    if batch_sink is not None:
+        res, failed = batch_sink.summaries, batch_sink.missing_docs()
+    else:
+        restore_doc_ids(res, batch, doc_id_key)
+        failed = batch if len(res) == 0 else []
+    if failed:
+        print_failed_docs(doc[doc_id_key] for doc in failed)
+        if metrics is not None:
+            metrics.count('failed_documents', len(failed))
+        if dead_letter is not None:
+            dead_letter.write(failed)
+
+    return res
+
+
+# hands the analyses of a batch to the sink as soon as they are decoded, with the real document IDs; only their IDs
+# and used characters are kept, the analyses handed over before a request was retried are not handed over again
+class BatchSink:
+
+    def __init__(self, batch, sink, doc_id_key='id'):
+        self.batch = batch
+        self.sink = sink
+        self.doc_id_key = doc_id_key
+        self.summaries = []
+        self.positions = set()
+
+    def __call__(self, doc_analysis):
+        position = int(doc_analysis[self.doc_id_key])
+        if position in self.positions:
+            return
+        self.positions.add(position)
+        doc_analysis[self.doc_id_key] = self.batch[position][self.doc_id_key]
+        self.summaries.append({self.doc_id_key: doc_analysis[self.doc_id_key], 'usedChars': doc_analysis['usedChars']})
+        self.sink(doc_analysis)
+
+    def missing_docs(self):
+        return [doc for position, doc in enumerate(self.batch) if position not in self.positions]
+
+
+def plan_batch_requests(batch):
+    # the documents of the requests make_batch_request sends for the batch and the too large documents it skips
+    if batch_request_size(batch) <= MAX_REQ_SIZE:
+        return [batch], []
+    if len(batch) == 1:
+        return [], batch
+
+    half = len(batch) // 2
+    requests, skipped = plan_batch_requests(batch[:half])
+    more_requests, more_skipped = plan_batch_requests(batch[half:])
+    return requests + more_requests, skipped + more_skipped
+
+
+def request_headers(user_key):
+    return {
         'Content-Type': 'application/json',
         'Authorization': 'user_key ' + user_key
     }
+
+
+def batch_request(batch, req_obj, docs_key='documents', doc_id_key='id'):
     req = {}
     req.update(req_obj)
-    req[docs_key] = list(batch)
+    # the real IDs stay in the batch, the API gets only the positions of the documents
+    req[docs_key] = [dict(doc, **{doc_id_key: str(index)}) for index, doc in enumerate(batch)]
+    return req
 
-    res = json_post(url, headers, req, session=session)
-    if len(res) == 0:
-        ids = ' '.join(doc[doc_id_key] for doc in batch)
-        print('failed to process documents: {ids}'.format(ids=ids), file=sys.stdout)
-        print('if the problems persist, please contact our support at support@geneea.com', file=sys.stderr)
-        sys.stderr.flush()
 
-    return res
+def restore_doc_ids(batch_analysis, batch, doc_id_key='id'):
+    for doc_analysis in batch_analysis:
+        doc_analysis[doc_id_key] = batch[int(doc_analysis[doc_id_key])][doc_id_key]
+    return batch_analysis
 
 
-def json_post(url, headers, data, session=None):
+def json_post(url, headers, data, session=None, retry=None, limiter=None, metrics=None, stream=False, sink=None):
+    # imported on the first request, the import is a large part of the startup time
+    import requests
+
     post = session.post if session else requests.post
+    start = time.perf_counter()
+    body = json.dumps(data)
+    if metrics is not None:
+        metrics.add_time('encode_request', time.perf_counter() - start)
+        post = functools.partial(measured_post, post, metrics)
+    attempt = 0
+    while True:
+        retry_after = None
+        if limiter is not None:
+            limiter.acquire()
+        try:
+            response = post(url, headers=headers, data=body, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT), stream=stream)
+            code = response.status_code
+            if code < 400:
+                if limiter is not None:
+                    limiter.on_success()
+                if stream:
+                    return decode_json_stream(response, metrics, sink)
+                if metrics is None:
+                    return response.json()
+                with metrics.timer('decode_response'):
+                    return json.loads(response.content)
+
+            if limiter is not None and code in THROTTLE_CODES:
+                limiter.on_throttle()
+            retryable = code in RETRY_CODES
+            retry_after = parse_retry_after(response.headers.get('Retry-After'))
+            print_error = functools.partial(print_http_error, code, response.text)
+        except requests.RequestException as e:
+            retryable = True
+            print_error = functools.partial(print_request_exception, e)
+        finally:
+            if limiter is not None:
+                limiter.release()
+
+        delay = None
+        if retry is not None and retryable and attempt < retry.max_retries:
+            delay = retry.next_delay(attempt, retry_after)
+        if delay is None:
+            print_error()
+            return []
+        time.sleep(delay)
+        attempt += 1
+
+
+def measured_post(post, metrics, url, *, data, stream=False, **kwargs):
+    metrics.request_started()
+    start = time.perf_counter()
+    received = 0
     try:
-        response = post(url, headers=headers, data=json.dumps(data), timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
-        code = response.status_code
-        if code >= 400:
-            try:
-                err = response.json()
-                print(
-                    'Internal error while communicating with the analysis API.',
-                    'HTTP error {code}, {e}: {msg}'.format(code=code, e=err['exception'], msg=err['message']),
-                    sep='\n', file=sys.stderr
-                )
-            except ValueError:
-                print(
-                    'Internal error while communicating with the analysis API.',
-                    'HTTP error {code}'.format(code=code),
-                    '{body}'.format(body=response.text),
-                    sep='\n', file=sys.stderr
-                )
+        response = post(url, data=data, stream=stream, **kwargs)
+        # the streamed responses are counted while they are decoded
+        if not stream or response.status_code >= 400:
+            received = len(response.content)
+        return response
+    finally:
+        observe_response(metrics, time.perf_counter() - start, sent=len(data), received=received)
+
+
+def observe_response(metrics, latency, *, sent, received):
+    metrics.request_finished(latency)
+    metrics.add_time('network', latency)
+    metrics.count('bytes_sent', sent)
+    metrics.count('bytes_received', received)
+
+
+def decode_json_stream(response, metrics=None, sink=None):
+    # with a sink, the values are handed to it one by one and none of them is kept
+    decoder = JsonArrayDecoder()
+    values = []
+    start = time.perf_counter()
+    with response:
+        for chunk in response.iter_content(STREAM_CHUNK_SIZE):
+            values += sink_values(decoder.feed(chunk), sink)
+        values += sink_values(decoder.close(), sink)
+    if metrics is not None:
+        metrics.add_time('decode_response', time.perf_counter() - start)
+        metrics.count('bytes_received', decoder.byte_count)
+    return values
+
+
+def sink_values(values, sink):
+    if sink is None:
+        return values
+    for value in values:
+        sink(value)
+    return []
+
+
+# decodes a JSON array element by element as its chunks arrive, only the unfinished element is kept as text
+class JsonArrayDecoder:
 
+    def __init__(self):
+        self.text_decoder = codecs.getincrementaldecoder('utf-8')()
+        self.json_decoder = json.JSONDecoder()
+        self.buffer = ''
+        self.byte_count = 0
+        # an unfinished element is decoded again only when the buffer doubles, so the decoding stays linear
+        self.min_size = 0
+        self.state = '['
+
+    def feed(self, chunk, final=False):
+        self.byte_count += len(chunk)
+        self.buffer += self.text_decoder.decode(chunk, final=final)
+        if len(self.buffer) < self.min_size and not final:
             return []
-    except requests.RequestException as e:
-        print(
-            'Internal error while communicating with the analysis API.',
-            'HTTP request exception, {type}: {e}'.format(type=type(e).__name__, e=e),
-            sep='\n', file=sys.stderr
-        )
-        return []
 
-    return response.json()
+        values = []
+        buf = self.buffer
+        pos = 0
+        while True:
+            pos = JSON_WHITESPACE.match(buf, pos).end()
+            if pos >= len(buf):
+                break
+            char = buf[pos]
+            if self.state == 'end':
+                raise ValueError('unexpected data after the end of the JSON array')
+            elif self.state == '[':
+                if char != '[':
+                    raise ValueError('the response is not a JSON array')
+                pos += 1
+                self.state = 'first'
+            elif char == ']' and self.state in ('first', ','):
+                pos += 1
+                self.state = 'end'
+            elif self.state == ',':
+                if char != ',':
+                    raise ValueError('invalid JSON array, expected "," at position {pos}'.format(pos=pos))
+                pos += 1
+                self.state = 'value'
+            else:
+                try:
+                    value, end = self.json_decoder.raw_decode(buf, pos)
+                except json.JSONDecodeError:
+                    if final:
+                        raise
+                    self.min_size = 2 * (len(buf) - pos)
+                    break
+                if isinstance(value, (int, float)) and not final:
+                    # a number is complete only when the separator after it has arrived
+                    next_pos = JSON_WHITESPACE.match(buf, end).end()
+                    if next_pos >= len(buf) or buf[next_pos] not in ',]':
+                        break
+                pos = end
+                values.append(value)
+                self.state = ','
+                self.min_size = 0
+        self.buffer = buf[pos:]
+        return values
+
+    def close(self):
+        values = self.feed(b'', final=True)
+        if self.state != 'end':
+            raise ValueError('incomplete JSON array')
+        return values
+
+
+def parse_retry_after(value):
+    # the header holds either the seconds to wait or the HTTP date to wait until
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    from datetime import datetime, timezone
+    from email.utils import parsedate_to_datetime
+    try:
+        date = parsedate_to_datetime(value)
+    except (TypeError, ValueError, IndexError):
+        return None
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return max(0.0, (date - datetime.now(timezone.utc)).total_seconds())
+
+
+class RetryPolicy:
+
+    def __init__(self, *, max_retries=MAX_RETRIES, backoff=RETRY_BACKOFF, max_backoff=RETRY_MAX_BACKOFF,
+                 retry_after_limit=RETRY_AFTER_LIMIT):
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.retry_after_limit = retry_after_limit
+        self.retry_count = 0
+        self.lock = threading.Lock()
+
+    def next_delay(self, attempt, retry_after=None):
+        # the request is given up when the server asks to wait longer than the limit
+        if retry_after is not None and retry_after > self.retry_after_limit:
+            print('The API asked to retry after {secs:.0f} seconds, more than the {limit:.0f} seconds limit, '
+                  'the request is not retried'.format(secs=retry_after, limit=self.retry_after_limit))
+            sys.stdout.flush()
+            return None
+        with self.lock:
+            self.retry_count += 1
+        # exponential backoff with full jitter, but never sooner than the server asked for
+        delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+
+class ConcurrencyLimiter:
+
+    def __init__(self, max_limit, *, min_limit=1):
+        self.max_limit = max_limit
+        self.min_limit = min(min_limit, max_limit)
+        self.limit = float(max_limit)
+        self.in_flight = 0
+        self.throttle_count = 0
+        self.last_throttle = 0.0
+        self.cond = threading.Condition()
+
+    def try_acquire(self):
+        with self.cond:
+            if self.in_flight >= int(self.limit):
+                return False
+            self.in_flight += 1
+            return True
+
+    def acquire(self):
+        with self.cond:
+            while self.in_flight >= int(self.limit):
+                self.cond.wait()
+            self.in_flight += 1
+
+    def release(self):
+        with self.cond:
+            self.in_flight -= 1
+            self.cond.notify()
+
+    def on_success(self):
+        with self.cond:
+            if self.limit < self.max_limit:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+                self.cond.notify_all()
+
+    def on_throttle(self):
+        with self.cond:
+            self.throttle_count += 1
+            # halve the window at most once per a cool-down period, the requests in flight see the same burst
+            now = time.monotonic()
+            if now - self.last_throttle >= THROTTLE_COOLDOWN:
+                self.last_throttle = now
+                self.limit = max(self.min_limit, self.limit / 2)
+
 
+class MemoryBudget:
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.peak = 0
+        self.cond = threading.Condition()
+
+    def charge(self, size):
+        with self.cond:
+            self.used += size
+            self.peak = max(self.peak, self.used)
+
+    def release(self, size):
+        with self.cond:
+            self.used -= size
+            self.cond.notify_all()
+
+    def release_after(self, size, count):
+        # a callback releasing the size once it was called "count" times, e.g. by all table writers
+        remaining = [count]
+
+        def done():
+            with self.cond:
+                remaining[0] -= 1
+                if remaining[0] > 0:
+                    return
+            self.release(size)
+
+        return done
+
+    def exceeded(self):
+        with self.cond:
+            return self.used >= self.limit
+
+    def wait(self):
+        with self.cond:
+            while self.used >= self.limit:
+                self.cond.wait()
+
+
+class DeadLetterWriter:
+
+    def __init__(self, path):
+        self.path = path
+        self.doc_count = 0
+        self.lock = threading.Lock()
+        self.file = None
+
+    def write(self, batch):
+        with self.lock:
+            if self.file is None:
+                self.file = open(self.path, 'a', encoding='utf-8')
+            self.file.write(json.dumps({'documents': list(batch)}) + '\n')
+            self.file.flush()
+            self.doc_count += len(batch)
+
+    def size(self):
+        with self.lock:
+            return os.path.getsize(self.path) if os.path.exists(self.path) else 0
+
+    def truncate(self, size):
+        # resuming from a checkpoint, the documents written after it are processed and written again
+        with self.lock:
+            if os.path.exists(self.path):
+                with open(self.path, 'r+b') as dead_letter_file:
+                    dead_letter_file.truncate(size)
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def read_dead_letters(path):
+    with open(path, 'r', encoding='utf-8') as dead_letter_file:
+        for line in dead_letter_file:
+            if line.strip():
+                yield from json.loads(line)['documents']
+
+
+def parallel_map(pool, fn, *iterables, lookahead=None, ordered=True, reorder_buffer=0, budget=None, **kwargs):
+    # imported only when the requests start, concurrent.futures imports the logging
+    from concurrent import futures
 
-def parallel_map(pool, fn, *iterables, **kwargs):
     argStream = zip(*iterables)
-    buffer = deque([pool.submit(fn, *args, **kwargs) for args in list(itertools.islice(argStream, 2 * pool._max_workers))])
+    lookahead = lookahead or 2 * pool._max_workers
+    if not ordered:
+        return unordered_result_iterator(pool, fn, argStream, lookahead, budget, kwargs)
+
+    buffer = deque()
     def result_iterator():
         try:
-            while buffer:
+            while True:
+                if reorder_buffer > 0:
+                    # keep at most "lookahead" futures running while at most "reorder_buffer"
+                    # finished ones are waiting for the older ones to be yielded in order, the bytes
+                    # of the waiting ones are bounded by the memory budget only
+                    running = sum(1 for future in buffer if not future.done())
+                    while running < lookahead and len(buffer) - running < reorder_buffer:
+                        next_futures = submit_next(pool, fn, argStream, kwargs, budget, wait=not buffer)
+                        if not next_futures:
+                            break
+                        buffer.extend(next_futures)
+                        running += 1
+                else:
+                    while len(buffer) < lookahead:
+                        next_futures = submit_next(pool, fn, argStream, kwargs, budget, wait=not buffer)
+                        if not next_futures:
+                            break
+                        buffer.extend(next_futures)
+                if not buffer:
+                    break
+
+                if reorder_buffer > 0 and not buffer[0].done():
+                    futures.wait([future for future in buffer if not future.done()],
+                                 return_when=futures.FIRST_COMPLETED)
+                    continue
+
                 future = buffer.popleft()
                 yield future.result()
-                try:
-                    args = next(argStream)
-                    buffer.append(pool.submit(fn, *args, **kwargs))
-                except StopIteration:
-                    pass
         finally:
             for future in buffer:
                 future.cancel()
     return result_iterator()
 
 
+def unordered_result_iterator(pool, fn, argStream, lookahead, budget, kwargs):
+    from concurrent import futures
+
+    pending = set()
+    try:
+        while True:
+            while len(pending) < lookahead:
+                next_futures = submit_next(pool, fn, argStream, kwargs, budget, wait=not pending)
+                if not next_futures:
+                    break
+                pending.update(next_futures)
+            if not pending:
+                break
+            done, pending = futures.wait(pending, return_when=futures.FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+def submit_next(pool, fn, argStream, kwargs, budget=None, wait=False):
+    # over the memory budget, no more input is read while there are results to be consumed first
+    if budget is not None and budget.exceeded():
+        if not wait:
+            return []
+        budget.wait()
+    for args in itertools.islice(argStream, 1):
+        return [pool.submit(fn, *args, **kwargs)]
+    return []
+
+
 def serialize_data(obj, compress=True):
+    import bz2
+    import pickle
+
     bin_data = pickle.dumps(obj)
     if compress:
         bin_data = bz2.compress(bin_data)
     return base64.encodebytes(bin_data).decode('ascii')
 
 
-def deserialize_data(ser_value, decompress=True):
+def deserialize_data(ser_value, decompress=True, dictionaries=()):
+    # the JSON codecs prefix the value with "<header>:<dictionary ID>:", a colon is not a base64 character
+    header = ser_value[:4]
+    if header in CODEC_BY_HEADER:
+        dict_id, _, data = ser_value[4:].partition(':')
+        dictionary = None
+        if dict_id:
+            dictionary = next((d for d in dictionaries if dictionary_id(d) == dict_id), None)
+            if dictionary is None:
+                raise ValueError('missing the compression dictionary with ID={id}'.format(id=dict_id))
+        bin_data = decompress_data(CODEC_BY_HEADER[header], base64.b64decode(data), dictionary)
+        return json.loads(bin_data.decode('utf-8'))
+
+    import bz2
+    import pickle
+
     bin_data = base64.decodebytes(ser_value.encode('ascii'))
     if decompress:
         bin_data = bz2.decompress(bin_data)
     return pickle.loads(bin_data)
+
+
+def make_serializer(codec=CODEC_PICKLE_BZ2, dictionary=None):
+    if codec == CODEC_PICKLE_BZ2:
+        return serialize_data
+
+    prefix = '{header}:{dict_id}:'.format(header=CODEC_HEADERS[codec], dict_id=dictionary_id(dictionary) if dictionary else '')
+    if codec == CODEC_JSON_ZSTD:
+        zstandard = import_zstandard()
+        dict_data = zstandard.ZstdCompressionDict(dictionary) if dictionary else None
+        compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL, dict_data=dict_data)
+        compress = compressor.compress
+    elif dictionary:
+        def compress(data):
+            compressor = zlib.compressobj(ZLIB_LEVEL, zdict=dictionary)
+            return compressor.compress(data) + compressor.flush()
+    else:
+        compress = functools.partial(zlib.compress, level=ZLIB_LEVEL)
+
+    def serialize(obj):
+        data = json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        return prefix + base64.b64encode(compress(data)).decode('ascii')
+    return serialize
+
+
+def decompress_data(codec, bin_data, dictionary=None):
+    if codec == CODEC_JSON_ZSTD:
+        zstandard = import_zstandard()
+        dict_data = zstandard.ZstdCompressionDict(dictionary) if dictionary else None
+        return zstandard.ZstdDecompressor(dict_data=dict_data).decompress(bin_data)
+    if dictionary:
+        decompressor = zlib.decompressobj(zdict=dictionary)
+        return decompressor.decompress(bin_data) + decompressor.flush()
+    return zlib.decompress(bin_data)
+
+
+def train_dictionary(samples, *, codec=CODEC_JSON_ZLIB, size=DICTIONARY_SIZE):
+    samples = [json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8') for obj in samples]
+    if codec == CODEC_JSON_ZSTD:
+        return import_zstandard().train_dictionary(size, samples).as_bytes()
+    # zlib can only use the last 32 KB of a preset dictionary, the most common content should be at its end
+    return b''.join(samples)[-min(size, ZLIB_DICTIONARY_SIZE):]
+
+
+def dictionary_id(dictionary):
+    return '{crc:08x}'.format(crc=zlib.crc32(dictionary))
+
+
+def import_zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise ValueError('the "{codec}" codec requires the "zstandard" package'.format(codec=CODEC_JSON_ZSTD))
+    return zstandard
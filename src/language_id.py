@@ -0,0 +1,68 @@
+# coding=utf-8
+# Python 3
+
+import re
+
+# the most frequent function words of the languages supported by the analysis API, a document is assigned
+# the language whose words it contains most often; the scripts decide the languages not written in Latin
+STOPWORDS = {
+    'cs': 'a se na je že v to do s z o jsem by jako ale jsou pro tak už jak jeho nebo není byl bylo být který které '
+          'také když jen po k ve při aby mezi však',
+    'sk': 'a sa na je že v to do s z o som by ako ale sú pre tak už ako jeho alebo nie bol bolo byť ktorý ktoré '
+          'tiež keď len po k vo pri aby medzi však',
+    'pl': 'i się na jest że w to do z o jak ale są dla tak już jego lub nie był było być który które także gdy '
+          'tylko po przy aby między jednak oraz',
+    'en': 'the and of to a in is that it for was on are with as be this by at not have from or an they which '
+          'you were has but their been we',
+    'de': 'der die und in den von zu das mit sich des auf für ist im dem nicht ein eine als auch es an werden aus '
+          'er hat dass sie nach wird bei',
+    'es': 'de la que el en y a los se del las un por con no una su para es al lo como más pero sus le ya o este '
+          'sí porque esta entre',
+    'fr': 'de la le et les des en un du une que est pour qui dans a par plus pas au sur ne se ce il sont avec '
+          'ou mais nous comme été',
+    'it': 'di e il la che in a per un è non una sono del della le si da con i al lo ma come anche gli più nel '
+          'alla questo',
+    'pt': 'de a o que e do da em um para é com não uma os no se na por mais as dos como mas foi ao ele das tem '
+          'à seu sua',
+    'nl': 'de en van het een in is dat op te zijn met voor niet aan er die als ook maar om door bij naar dan '
+          'was wordt worden heeft',
+}
+
+SCRIPTS = [
+    ('ru', re.compile('[Ѐ-ӿ]')),
+]
+LANGUAGES = frozenset(STOPWORDS) | frozenset(lang for lang, _ in SCRIPTS)
+WORD_PATTERN = re.compile(r'\w+')
+
+DETECT_CHARS = 2000
+MIN_WORD_HITS = 3
+MIN_MARGIN = 1.25
+
+
+class LanguageDetector:
+
+    def __init__(self, languages=LANGUAGES, *, max_chars=DETECT_CHARS):
+        self.max_chars = max_chars
+        self.scripts = [(lang, pattern) for lang, pattern in SCRIPTS if lang in languages]
+        self.word_langs = {}
+        for lang, words in STOPWORDS.items():
+            if lang in languages:
+                for word in words.split():
+                    self.word_langs.setdefault(word, []).append(lang)
+
+    def detect(self, text):
+        sample = text[:self.max_chars]
+        for lang, pattern in self.scripts:
+            if len(pattern.findall(sample)) > len(sample) // 4:
+                return lang
+
+        scores = {}
+        for word in WORD_PATTERN.findall(sample.lower()):
+            for lang in self.word_langs.get(word, ()):
+                scores[lang] = scores.get(lang, 0) + 1
+        ranking = sorted(scores.values(), reverse=True) + [0, 0]
+        best, second = ranking[0], ranking[1]
+        # unsure results are left to the API, e.g. of the very close Czech and Slovak
+        if best < MIN_WORD_HITS or best < MIN_MARGIN * second:
+            return None
+        return max(scores, key=scores.get)
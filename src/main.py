@@ -1,6 +1,11 @@
 # coding=utf-8
 # Python 3
 
+import time
+
+# the startup time of the component, the imports and the configuration, is reported in the metrics
+START = time.perf_counter()
+
 import argparse
 import sys
 import traceback
@@ -14,6 +19,7 @@ def main():
         args = parser.parse_args()
 
         app = AnalysisApp(data_dir=args.data_dir)
+        app.metrics.add_time('startup', time.perf_counter() - START)
         app.run()
 
         sys.exit(0)
@@ -0,0 +1,135 @@
+# coding=utf-8
+# Python 3
+
+import contextlib
+import math
+import threading
+import time
+
+from collections import defaultdict
+
+# the latency histogram has logarithmic buckets, each 10% wider than the previous one, starting at 1ms
+LATENCY_MIN = 0.001
+LATENCY_GROWTH = 1.1
+LATENCY_PERCENTILES = (50, 95, 99)
+
+
+class Metrics:
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.lock = threading.Lock()
+        self.stage_times = defaultdict(float)
+        self.counters = defaultdict(int)
+        self.latency_buckets = defaultdict(int)
+        self.latency_count = 0
+        self.latency_sum = 0.0
+        self.latency_max = 0.0
+        self.in_flight = 0
+        self.in_flight_max = 0
+        self.in_flight_sum = 0
+        self.request_count = 0
+        self.batch_count = 0
+        self.batch_docs = 0
+        self.batch_bytes = 0
+        self.batch_docs_max = 0
+        self.batch_bytes_max = 0
+
+    def add_time(self, stage, seconds):
+        with self.lock:
+            self.stage_times[stage] += seconds
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.perf_counter() - start)
+
+    def timed(self, stage, fn):
+        def timed_fn(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.add_time(stage, time.perf_counter() - start)
+
+        return timed_fn
+
+    def timed_stream(self, stage, stream):
+        # only the time spent in the stream itself is measured, not the time of the consumer between the items
+        stream = iter(stream)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(stream)
+            except StopIteration:
+                self.add_time(stage, time.perf_counter() - start)
+                return
+            self.add_time(stage, time.perf_counter() - start)
+            yield item
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    def request_started(self):
+        with self.lock:
+            self.request_count += 1
+            self.in_flight += 1
+            self.in_flight_max = max(self.in_flight_max, self.in_flight)
+            self.in_flight_sum += self.in_flight
+
+    def request_finished(self, latency):
+        bucket = max(0, int(math.log(max(latency, LATENCY_MIN) / LATENCY_MIN, LATENCY_GROWTH)))
+        with self.lock:
+            self.in_flight -= 1
+            self.latency_buckets[bucket] += 1
+            self.latency_count += 1
+            self.latency_sum += latency
+            self.latency_max = max(self.latency_max, latency)
+
+    def observe_batch(self, doc_count, size):
+        with self.lock:
+            self.batch_count += 1
+            self.batch_docs += doc_count
+            self.batch_bytes += size
+            self.batch_docs_max = max(self.batch_docs_max, doc_count)
+            self.batch_bytes_max = max(self.batch_bytes_max, size)
+
+    def latency_percentile(self, percentile):
+        rank = math.ceil(self.latency_count * percentile / 100)
+        seen = 0
+        for bucket in sorted(self.latency_buckets):
+            seen += self.latency_buckets[bucket]
+            if seen >= rank:
+                # the upper bound of the bucket, but never more than the real maximum
+                return min(self.latency_max, LATENCY_MIN * LATENCY_GROWTH ** (bucket + 1))
+        return self.latency_max
+
+    def snapshot(self):
+        with self.lock:
+            latency = {'count': self.latency_count}
+            if self.latency_count:
+                latency['mean'] = round(self.latency_sum / self.latency_count, 4)
+                for percentile in LATENCY_PERCENTILES:
+                    latency['p{p}'.format(p=percentile)] = round(self.latency_percentile(percentile), 4)
+                latency['max'] = round(self.latency_max, 4)
+            return {
+                'elapsed_seconds': round(time.perf_counter() - self.start, 3),
+                'stage_seconds': {stage: round(secs, 3) for stage, secs in sorted(self.stage_times.items())},
+                'request_latency_seconds': latency,
+                'in_flight_requests': {
+                    'max': self.in_flight_max,
+                    'mean': round(self.in_flight_sum / self.request_count, 2) if self.request_count else 0
+                },
+                'batches': {
+                    'count': self.batch_count,
+                    'mean_docs': round(self.batch_docs / self.batch_count, 2) if self.batch_count else 0,
+                    'max_docs': self.batch_docs_max,
+                    'mean_bytes': round(self.batch_bytes / self.batch_count) if self.batch_count else 0,
+                    'max_bytes': self.batch_bytes_max
+                },
+                'counters': dict(sorted(self.counters.items()))
+            }
@@ -0,0 +1,47 @@
+# coding=utf-8
+# Python 3
+
+# the columns of the output tables following the ID columns, the flatteners yield the rows as tuples
+# of the ID values and the values of these columns in this order
+SENTIMENT_COLUMNS = ['sentimentValue', 'sentimentPolarity', 'sentimentLabel', 'sentimentDetailedLabel']
+DOC_COLUMNS = ['language'] + SENTIMENT_COLUMNS + ['usedChars']
+SNT_COLUMNS = ['index', 'segment', 'text'] + SENTIMENT_COLUMNS
+ENT_COLUMNS = ['type', 'text', 'score', 'entityUid'] + SENTIMENT_COLUMNS
+REL_COLUMNS = ['type', 'name', 'negated', 'subject', 'object', 'subjectType', 'objectType', 'subjectUid',
+               'objectUid'] + SENTIMENT_COLUMNS
+FULL_COLUMNS = ['binaryData']
+
+NO_SENTIMENT = (None, None, None, None)
+
+
+def sentiment_values(obj):
+    sentiment = obj.get('sentiment')
+    if sentiment is None:
+        return NO_SENTIMENT
+    polarity = sentiment['polarity']
+    if polarity > 0: label = 'positive'
+    elif polarity < 0: label = 'negative'
+    else: label = 'neutral'
+    return sentiment['value'], polarity, label, sentiment['label']
+
+
+def doc_rows(doc_analysis, id_values):
+    yield id_values + (doc_analysis['language'],) + sentiment_values(doc_analysis) + (doc_analysis['usedChars'],)
+
+
+def snt_rows(doc_analysis, id_values):
+    for index, snt in enumerate(doc_analysis.get('sentences', ())):
+        yield id_values + (index, snt['segment'], snt['text']) + sentiment_values(snt)
+
+
+def ent_rows(doc_analysis, id_values):
+    for ent in doc_analysis.get('entities', ()):
+        yield id_values + (ent['type'], ent['text'], ent['score'], ent.get('uid')) + sentiment_values(ent)
+
+
+def rel_rows(doc_analysis, id_values):
+    for rel in doc_analysis.get('relations', ()):
+        yield id_values + (
+            rel['type'], rel['name'], rel['negated'], rel.get('subjectName'), rel.get('objectName'),
+            rel.get('subjectType'), rel.get('objectType'), rel.get('subjectUid'), rel.get('objectUid')
+        ) + sentiment_values(rel)
@@ -0,0 +1,51 @@
+# coding=utf-8
+# Python 3
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    raise ValueError('the "parquet" output format requires the "pyarrow" package, '
+                     'the image has to be built with the "PARQUET=1" argument')
+
+PARQUET_ROW_GROUP_SIZE = 64 * 1024
+PARQUET_COMPRESSION = 'zstd'
+
+ARROW_TYPES = {
+    'string': pyarrow.string(),
+    'int': pyarrow.int64(),
+    'float': pyarrow.float64(),
+    'bool': pyarrow.bool_()
+}
+
+
+class ParquetRowWriter:
+
+    def __init__(self, path, *, fields, types, row_group_size=PARQUET_ROW_GROUP_SIZE, compression=PARQUET_COMPRESSION):
+        self.path = path
+        self.fields = fields
+        self.row_group_size = row_group_size
+        self.schema = pyarrow.schema([(field, ARROW_TYPES[types.get(field, 'string')]) for field in fields])
+        self.columns = [[] for _ in fields]
+        self.row_count = 0
+        self.writer = pyarrow.parquet.ParquetWriter(path, self.schema, compression=compression)
+
+    def writerows(self, rows):
+        for row in rows:
+            for value, column in zip(row, self.columns):
+                column.append(value)
+            self.row_count += 1
+            if self.row_count >= self.row_group_size:
+                self.flush()
+
+    def flush(self):
+        if not self.row_count:
+            return
+        arrays = [pyarrow.array(column, type=field.type) for column, field in zip(self.columns, self.schema)]
+        self.writer.write_table(pyarrow.Table.from_arrays(arrays, schema=self.schema), row_group_size=self.row_count)
+        self.columns = [[] for _ in self.fields]
+        self.row_count = 0
+
+    def close(self):
+        self.flush()
+        self.writer.close()
@@ -0,0 +1,83 @@
+# coding=utf-8
+# Python 3
+
+import hashlib
+import json
+import sqlite3
+import time
+import zlib
+
+CACHE_MAX_ENTRIES = 1000000
+CACHE_TTL_DAYS = 30
+
+
+class ResultCache:
+
+    def __init__(self, path, *, max_entries=CACHE_MAX_ENTRIES, ttl_days=CACHE_TTL_DAYS):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl_days * 24 * 3600 if ttl_days else None
+        self.hits = 0
+        self.misses = 0
+        self.hit_chars = 0
+
+        self.conn = sqlite3.connect(path)
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS results ('
+            '  key TEXT PRIMARY KEY,'
+            '  value BLOB NOT NULL,'
+            '  created REAL NOT NULL,'
+            '  accessed REAL NOT NULL'
+            ')'
+        )
+        self.conn.execute('CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed)')
+        self.conn.commit()
+
+    @staticmethod
+    def make_key(doc, req):
+        key_data = json.dumps([req, doc], sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(key_data.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        now = time.time()
+        row = self.conn.execute('SELECT value, created FROM results WHERE key = ?', (key,)).fetchone()
+        if row is None or (self.ttl and row[1] < now - self.ttl):
+            self.misses += 1
+            return None
+
+        self.conn.execute('UPDATE results SET accessed = ? WHERE key = ?', (now, key))
+        self.hits += 1
+        return json.loads(zlib.decompress(row[0]).decode('utf-8'))
+
+    def put(self, key, doc_analysis):
+        now = time.time()
+        value = zlib.compress(json.dumps(doc_analysis, ensure_ascii=False).encode('utf-8'))
+        self.conn.execute(
+            'INSERT OR REPLACE INTO results (key, value, created, accessed) VALUES (?, ?, ?, ?)',
+            (key, value, now, now)
+        )
+
+    def evict(self):
+        if self.ttl:
+            self.conn.execute('DELETE FROM results WHERE created < ?', (time.time() - self.ttl,))
+        if self.max_entries:
+            self.conn.execute(
+                'DELETE FROM results WHERE key IN ('
+                '  SELECT key FROM results ORDER BY accessed DESC LIMIT -1 OFFSET ?'
+                ')',
+                (self.max_entries,)
+            )
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.evict()
+        self.conn.commit()
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,51 @@
+# coding=utf-8
+# Python 3
+
+import html
+import re
+
+MARKUP_PATTERN = re.compile(r'<[a-zA-Z/!]')
+INVISIBLE_BLOCK_PATTERN = re.compile(r'<(script|style|head)\b.*?</\1\s*>', re.IGNORECASE | re.DOTALL)
+COMMENT_PATTERN = re.compile(r'<!--.*?-->', re.DOTALL)
+BLOCK_TAG_PATTERN = re.compile(r'<\s*/?\s*(p|div|br|li|ul|ol|tr|table|h[1-6]|section|article|blockquote)\b[^>]*>',
+                               re.IGNORECASE)
+TAG_PATTERN = re.compile(r'<[^>]*>')
+SPACE_PATTERN = re.compile(r'[^\S\n]+')
+NEWLINES_PATTERN = re.compile(r'\s*\n\s*\n\s*')
+LINE_PATTERN = re.compile(r' *\n *')
+
+# the preferred places to split a text, from the best one
+SPLIT_SEPARATORS = ('\n\n', '\n', '. ', ' ')
+
+
+def normalize_text(text):
+    if MARKUP_PATTERN.search(text):
+        text = INVISIBLE_BLOCK_PATTERN.sub(' ', text)
+        text = COMMENT_PATTERN.sub(' ', text)
+        text = BLOCK_TAG_PATTERN.sub('\n\n', text)
+        text = TAG_PATTERN.sub(' ', text)
+    if '&' in text:
+        text = html.unescape(text)
+    text = SPACE_PATTERN.sub(' ', text)
+    text = NEWLINES_PATTERN.sub('\n\n', text)
+    text = LINE_PATTERN.sub('\n', text)
+    return text.strip()
+
+
+def split_text(text, size):
+    while len(text) > size:
+        cut = size
+        for separator in SPLIT_SEPARATORS:
+            # do not cut too close to the start, the chunks would get too small
+            pos = text.rfind(separator, size // 2, size)
+            if pos >= 0:
+                cut = pos + len(separator)
+                break
+        yield text[:cut]
+        text = text[cut:]
+    if text:
+        yield text
+
+
+def truncate_text(text, size):
+    return next(split_text(text, size), '')
@@ -0,0 +1,164 @@
+# coding=utf-8
+# Python 3
+
+import csv
+import io
+import json
+import os
+import random
+import sys
+import urllib.request
+
+import pytest
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT_DIR, 'src'))
+sys.path.insert(0, os.path.join(ROOT_DIR, 'benchmark'))
+
+from kbc_tools import JsonArrayDecoder, decode_json_stream, csv_shards, read_csv_shard, read_csv_mapped
+from mock_api import MockApi
+
+
+def feed_chunks(data, sizes):
+    decoder = JsonArrayDecoder()
+    values = []
+    pos = 0
+    for size in sizes:
+        values += decoder.feed(data[pos:pos + size])
+        pos += size
+    values += decoder.feed(data[pos:])
+    return values + decoder.close()
+
+
+def random_sizes(rnd, length):
+    sizes = []
+    while sum(sizes) < length:
+        sizes.append(rnd.randint(0, 64))
+    return sizes
+
+
+# a fake streamed response of the requests package
+class ChunkedResponse:
+
+    def __init__(self, data, sizes):
+        self.data = data
+        self.sizes = sizes
+
+    def iter_content(self, chunk_size):
+        pos = 0
+        for size in self.sizes:
+            yield self.data[pos:pos + size]
+            pos += size
+        yield self.data[pos:]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+@pytest.fixture(scope='module')
+def api_response():
+    # the analyses of the local stub of the analysis API
+    docs = [{'id': str(i), 'text': 'Příliš žluťoučký kůň ' * (i * 7 % 40 + 1)} for i in range(30)]
+    with MockApi(latency=0.0) as api:
+        request = urllib.request.Request(api.url, data=json.dumps({'documents': docs}).encode('utf-8'),
+                                         headers={'Content-Type': 'application/json'})
+        with urllib.request.urlopen(request) as response:
+            return response.read()
+
+
+def test_decoder_byte_by_byte(api_response):
+    assert feed_chunks(api_response, [1] * len(api_response)) == json.loads(api_response.decode('utf-8'))
+
+
+def test_decoder_random_chunks(api_response):
+    rnd = random.Random(7)
+    expected = json.loads(api_response.decode('utf-8'))
+    for _ in range(50):
+        assert feed_chunks(api_response, random_sizes(rnd, len(api_response))) == expected
+
+
+def test_decode_json_stream(api_response):
+    rnd = random.Random(11)
+    expected = json.loads(api_response.decode('utf-8'))
+    response = ChunkedResponse(api_response, random_sizes(rnd, len(api_response)))
+    assert decode_json_stream(response) == expected
+
+    handed = []
+    response = ChunkedResponse(api_response, random_sizes(rnd, len(api_response)))
+    assert decode_json_stream(response, sink=handed.append) == []
+    assert handed == expected
+
+
+@pytest.mark.parametrize('data', [
+    '[]',
+    ' [ 1 , 22 , -3.5e2 , true , null , "a\\"]b" , {"c": [1, 2]} ] ',
+    '[12345, 678]',
+    '["čšř", "日本語", "\\u00e9"]',
+    '[[], {}, "", 0]'
+])
+def test_decoder_values(data):
+    encoded = data.encode('utf-8')
+    expected = json.loads(data)
+    for size in range(1, len(encoded) + 1):
+        assert feed_chunks(encoded, [size] * (len(encoded) // size)) == expected
+
+
+@pytest.mark.parametrize('data', ['{"a": 1}', '[1, 2', '[1 2]', '[1, 2] 3', '[1,]', ''])
+def test_decoder_invalid(data):
+    with pytest.raises(ValueError):
+        feed_chunks(data.encode('utf-8'), [1] * len(data))
+
+
+def write_table(path, rows):
+    with open(path, 'w', encoding='utf-8', newline='') as out_tab:
+        csv.writer(out_tab, dialect='kbc').writerows(rows)
+
+
+def expected_rows(path):
+    with open(path, 'r', encoding='utf-8', newline='') as in_tab:
+        return list(csv.reader(io.StringIO(in_tab.read().replace('\0', '')), dialect='kbc'))
+
+
+@pytest.fixture
+def tricky_table(tmp_path):
+    # quoted line breaks, doubled quotes, NUL characters, multi-byte characters and short rows
+    rows = [['id', 'title', 'text']]
+    rnd = random.Random(3)
+    pieces = ['plain', 'line\nbreak', 'two\n\nbreaks', '"quoted"', 'comma, here', 'nul\0byte', 'ř\n"ž"', '', '\n']
+    for i in range(60):
+        row = [str(i), rnd.choice(pieces), ''.join(rnd.choice(pieces) for _ in range(rnd.randint(0, 4)))]
+        rows.append(row[:2] if i % 13 == 5 else row)
+    path = str(tmp_path / 'input.csv')
+    write_table(path, rows)
+    return path
+
+
+def test_csv_shards_boundaries(tricky_table):
+    expected = expected_rows(tricky_table)
+    fieldnames = expected[0]
+    size = os.path.getsize(tricky_table)
+    # the small shards end in the middle of nearly every record, the shard boundary moves to the record end
+    for shard_size in list(range(1, 40)) + [size // 2, size, size + 1]:
+        shards = list(csv_shards(tricky_table, shard_size))
+        assert all(end > start for start, end in shards)
+        assert all(end == start for (_, end), (start, _) in zip(shards, shards[1:]))
+        rows = [row for start, end in shards for row in read_csv_shard(tricky_table, start, end, fieldnames)]
+        assert [[row[col] for col in fieldnames if row[col] is not None] for row in rows] == expected[1:]
+
+
+def test_read_csv_mapped_blocks(tricky_table):
+    expected = expected_rows(tricky_table)
+    columns = ['text', 'id']
+    for block_size in (1, 2, 3, 7, 16, 64, 1024 * 1024):
+        rows = list(read_csv_mapped(tricky_table, columns, block_size=block_size))
+        assert rows == [(row[2] if len(row) > 2 else None, row[0]) for row in expected[1:]]
+
+
+def test_empty_table(tmp_path):
+    path = str(tmp_path / 'empty.csv')
+    open(path, 'w').close()
+    assert list(csv_shards(path, 10)) == []
+    assert list(read_csv_mapped(path, ['id'])) == []